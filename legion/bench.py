@@ -0,0 +1,411 @@
+"""
+Measure how long the jobs published to a swarm take to come back: publish a
+mix of jobs at a set rate and follow every return of the swarm's minions and
+fakes on the master's event bus
+"""
+# Import python libs
+from __future__ import absolute_import, print_function
+import json
+import time
+import shlex
+import random
+import optparse
+import threading
+
+# Import salt libs
+import salt.client
+import salt.config
+import salt.utils.files
+
+# Import legion libs
+import legion.legion
+import legion.pacing
+import legion.readiness
+import legion.stats
+
+
+class Job(object):
+    """
+    A published job, the returns that came back for it and when
+    """
+
+    def __init__(self, size):
+        self.fun = None
+        self.published = None
+        self.slots = None
+        self.first = None
+        self.last = None
+        self.returns = 0
+        self.early = []
+        self.seen = bytearray(size // 8 + 1)
+        self.latency = legion.stats.Histogram()
+
+    def returned(self, slot, stamp):
+        """
+        Record the return of the id in ``slot``, once, and count it when the
+        job expects it. Returns that beat the publish call back are held
+        until the job knows which ids it expects.
+        """
+        if self.seen[slot >> 3] & (1 << (slot & 7)):
+            return
+        self.seen[slot >> 3] |= 1 << (slot & 7)
+        if self.slots is None:
+            self.early.append((slot, stamp))
+        elif slot in self.slots:
+            self._count(stamp)
+
+    def expect(self, slots, published):
+        """
+        Expect returns from the ids in ``slots`` of the job published at
+        ``published``, and count the returns that already came in
+        """
+        self.slots = frozenset(slots)
+        self.published = published
+        early, self.early = self.early, []
+        for slot, stamp in early:
+            if slot in self.slots:
+                self._count(stamp)
+
+    def _count(self, stamp):
+        self.returns += 1
+        if self.first is None or stamp < self.first:
+            self.first = stamp
+        if self.last is None or stamp > self.last:
+            self.last = stamp
+        self.latency.record(stamp - self.published)
+
+    @property
+    def expected(self):
+        return len(self.slots) if self.slots is not None else 0
+
+    @property
+    def missing(self):
+        return max(0, self.expected - self.returns)
+
+    def to_dict(self, jid):
+        """
+        Summarize the job, the times are in seconds after the publish
+        """
+        ret = {
+            "jid": jid,
+            "fun": self.fun,
+            "expected": self.expected,
+            "returns": self.returns,
+            "missing": self.missing,
+            "first": None,
+            "last": None,
+            "p50": self.latency.quantile(0.5),
+            "p99": self.latency.quantile(0.99),
+        }
+        if self.first is not None:
+            ret["first"] = self.first - self.published
+            ret["last"] = self.last - self.published
+        return ret
+
+
+class Bench(object):
+    """
+    Publish the job mix and match every return to its job.
+
+    Every job expects a return from the ids of the swarm the master published
+    it to, or from the minions and their first ``active`` fakes when only
+    that many fakes of every minion return.
+    """
+
+    def __init__(self, opts):
+        self.opts = opts
+        self.layout = legion.readiness.Layout(
+            opts["name"], opts["minions"], opts["legion"]
+        )
+        self.mix = parse_mix(opts["job"] or ["test.ping"])
+        self.jobs = {}
+        self.client = None
+        self.active = None
+        self._lock = threading.Lock()
+
+    def job(self, jid):
+        with self._lock:
+            job = self.jobs.get(jid)
+            if job is None:
+                job = self.jobs[jid] = Job(self.layout.size)
+            return job
+
+    def listen(self, event):
+        """
+        Match the returns on the event bus to their jobs, a return can come in
+        before its publish call came back with the jid
+        """
+        for tag, data in legion.legion.iter_events(event=event):
+            if not tag.startswith("salt/job/") or "/ret/" not in tag:
+                continue
+            slot = self.layout.slot(data.get("id", ""))
+            if slot is None:
+                continue
+            job = self.job(data["jid"])
+            with self._lock:
+                job.returned(slot, time.time())
+
+    def expects(self, minions):
+        """
+        Return the slots of the ``minions`` a job was published to that return
+        """
+        slots = set()
+        for id_ in minions:
+            slot = self.layout.slot(id_)
+            if slot is None:
+                continue
+            if self.active is None or slot % (self.layout.fakes + 1) <= self.active:
+                slots.add(slot)
+        return slots
+
+    def publish(self, client, fun, args):
+        """
+        Publish one job to the swarm
+        """
+        published = time.time()
+        pub = client.run_job(
+            self.opts["target"],
+            fun,
+            args,
+            tgt_type=self.opts["tgt_type"],
+            timeout=self.opts["timeout"],
+        )
+        if not pub or "jid" not in pub:
+            print("Failed to publish {0}".format(fun))
+            return None
+        job = self.job(pub["jid"])
+        with self._lock:
+            job.fun = fun
+            job.expect(self.expects(pub.get("minions") or ()), published)
+        return pub["jid"]
+
+    def start(self):
+        """
+        Start following the returns on the master's event bus
+        """
+        mopts = salt.config.client_config(self.opts["config"])
+        event = legion.legion.master_event(mopts)
+        thread = threading.Thread(target=self.listen, args=(event,))
+        thread.daemon = True
+        thread.start()
+        self.client = salt.client.LocalClient(mopts=mopts)
+
+    def run(self):
+        """
+        Publish ``count`` jobs at ``rate`` jobs a second and wait for their
+        returns, up to ``timeout`` seconds after the last publish
+        """
+        if self.client is None:
+            self.start()
+        pacer = legion.pacing.pacer(
+            self.opts["ramp_profile"],
+            self.opts["rate"],
+            ramp=self.opts["ramp_time"],
+            seed=self.opts["seed"],
+        )
+        rand = random.Random(self.opts["seed"])
+        weights = [weight for _, _, weight in self.mix]
+        jids = []
+        for _ in range(self.opts["count"]):
+            pacer.acquire()
+            fun, args, _ = rand.choices(self.mix, weights)[0]
+            jid = self.publish(self.client, fun, args)
+            if jid is not None:
+                jids.append(jid)
+
+        deadline = time.time() + self.opts["timeout"]
+        while time.time() < deadline:
+            with self._lock:
+                if not any(self.jobs[jid].missing for jid in jids):
+                    break
+            time.sleep(0.5)
+        with self._lock:
+            return self.report(jids)
+
+    def report(self, jids):
+        """
+        Summarize every job, every function of the mix and the whole run
+        """
+
+        def _summary(jobs):
+            first = legion.stats.Histogram()
+            last = legion.stats.Histogram()
+            latency = legion.stats.Histogram()
+            expected = missing = 0
+            for job in jobs:
+                expected += job.expected
+                missing += job.missing
+                latency.merge(job.latency)
+                if job.first is not None:
+                    first.record(job.first - job.published)
+                    last.record(job.last - job.published)
+            ret = {"jobs": len(jobs), "expected": expected}
+            ret["missing"] = missing
+            for name, hist in (("first", first), ("last", last), ("return", latency)):
+                ret[name] = legion.stats.report({}, {name: hist})["phases"][name]
+            return ret
+
+        jobs = [self.jobs[jid] for jid in jids]
+        ret = {
+            "jobs": [job.to_dict(jid) for jid, job in zip(jids, jobs)],
+            "funs": dict(
+                (fun, _summary([job for job in jobs if job.fun == fun]))
+                for fun in set(job.fun for job in jobs)
+            ),
+            "run": _summary(jobs),
+        }
+        return ret
+
+
+def parse_mix(specs):
+    """
+    Parse the ``[WEIGHT:]FUN [ARG ...]`` job specs of the mix
+    """
+    mix = []
+    for spec in specs:
+        weight, _, rest = spec.partition(":")
+        try:
+            weight = float(weight)
+        except ValueError:
+            weight, rest = 1.0, spec
+        parts = shlex.split(rest)
+        mix.append((parts[0], parts[1:], weight))
+    return mix
+
+
+def parse(args):
+    """
+    Parse the cli options of ``legion bench``
+    """
+    parser = optparse.OptionParser(usage="%prog bench [options]")
+    parser.add_option(
+        "-m",
+        "--minions",
+        dest="minions",
+        default=5,
+        type="int",
+        help="The number of minions of the swarm",
+    )
+    parser.add_option(
+        "-l",
+        "--legion",
+        dest="legion",
+        default=0,
+        type="int",
+        help="The number of legion fakes of every minion of the swarm",
+    )
+    parser.add_option(
+        "--name",
+        "-n",
+        dest="name",
+        default="ms",
+        help="The id prefix of the minions of the swarm",
+    )
+    parser.add_option(
+        "-t",
+        "--target",
+        dest="target",
+        default=None,
+        help="The target of the jobs, every minion of the swarm by default",
+    )
+    parser.add_option(
+        "--tgt-type",
+        dest="tgt_type",
+        default="glob",
+        help="The type of the target",
+    )
+    parser.add_option(
+        "-j",
+        "--job",
+        dest="job",
+        default=[],
+        action="append",
+        help=(
+            "A job of the mix as [WEIGHT:]FUN [ARG ...], e.g. "
+            "'3:test.ping' or '1:test.sleep 1'. test.ping by default"
+        ),
+    )
+    parser.add_option(
+        "-r",
+        "--rate",
+        dest="rate",
+        default=1.0,
+        type="float",
+        help="Jobs published a second, 0 for no limit",
+    )
+    parser.add_option(
+        "--ramp-profile",
+        dest="ramp_profile",
+        default="constant",
+        type="choice",
+        choices=legion.pacing.PROFILES,
+        help="The shape the publishes follow on their way to --rate",
+    )
+    parser.add_option(
+        "--ramp-time",
+        dest="ramp_time",
+        default=0.0,
+        type="float",
+        help="Seconds it takes to ramp up to --rate",
+    )
+    parser.add_option(
+        "-c",
+        "--count",
+        dest="count",
+        default=10,
+        type="int",
+        help="The number of jobs to publish",
+    )
+    parser.add_option(
+        "--timeout",
+        dest="timeout",
+        default=60.0,
+        type="float",
+        help="Seconds to wait for the returns after the last publish",
+    )
+    parser.add_option(
+        "--seed",
+        dest="seed",
+        default=0,
+        type="int",
+        help="The seed of the job mix, so runs publish the same jobs",
+    )
+    parser.add_option(
+        "--config",
+        dest="config",
+        default="/etc/salt/master",
+        help="The config of the master to publish to",
+    )
+    parser.add_option(
+        "--report",
+        dest="report",
+        default="legion-bench.json",
+        help="The JSON file the report is written to",
+    )
+    options, _args = parser.parse_args(args)
+    opts = dict(options.__dict__)
+    if opts["target"] is None:
+        opts["target"] = "{0}-*".format(opts["name"])
+    return opts
+
+
+def main(args):
+    opts = parse(args)
+    report = Bench(opts).run()
+    for name, val in [("all", report["run"])] + sorted(report["funs"].items()):
+        print(
+            "{0}: {1} jobs, {2}/{3} returns missing, first return {4:.3f}s p50 "
+            "{5:.3f}s p99, last return {6:.3f}s p50 {7:.3f}s p99".format(
+                name,
+                val["jobs"],
+                val["missing"],
+                val["expected"],
+                val["first"]["p50"],
+                val["first"]["p99"],
+                val["last"]["p50"],
+                val["last"]["p99"],
+            )
+        )
+    with salt.utils.files.fopen(opts["report"], "w") as fp_:
+        json.dump(report, fp_, indent=2, sort_keys=True)
+    print("Report written to {0}".format(opts["report"]))
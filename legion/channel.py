@@ -0,0 +1,218 @@
+"""
+Pools of ReqChannels to the master that outlive a single returner or execution
+module call, so a fake's return or sign in does not pay for a fresh connection
+and AES session every time
+"""
+# Import python libs
+import os
+import time
+import atexit
+import logging
+import threading
+import contextlib
+
+# Import salt libs
+import salt.crypt
+import salt.transport.client
+from salt.exceptions import SaltClientError, SaltReqTimeoutError
+
+# Import third party libs
+try:
+    import salt.ext.tornado.gen as tornado_gen
+except ImportError:
+    import tornado.gen as tornado_gen
+
+log = logging.getLogger(__name__)
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+
+def factory(opts, crypt="aes"):
+    """
+    Create a new ReqChannel to the master
+    """
+    return salt.transport.client.ReqChannel.factory(opts, crypt=crypt)
+
+
+@tornado_gen.coroutine
+def _crypted_transfer(channel, payload, timeout):
+    """
+    Encrypt and send an already serialized load over an async aes channel
+    """
+    for attempt in range(2):
+        if not channel.auth.authenticated:
+            yield channel.auth.authenticate()
+        crypticle = channel.auth.crypticle
+        load = crypticle.encrypt(crypticle.PICKLE_PAD + payload)
+        ret = yield channel.message_client.send(
+            channel._package_load(load), timeout=timeout
+        )
+        try:
+            data = crypticle.loads(ret)
+        except salt.crypt.AuthenticationError:
+            # The master rotated its AES key, sign in again and resend
+            if attempt:
+                raise
+            yield channel.auth.authenticate()
+            continue
+        raise tornado_gen.Return(data)
+
+
+def send_serialized(channel, payload, timeout=30):
+    """
+    Send a load that is already msgpack serialized over an aes ReqChannel,
+    without the channel serializing it a second time
+    """
+    if hasattr(channel, "send_serialized"):
+        return channel.send_serialized(payload, timeout=timeout)
+    return channel.io_loop.run_sync(
+        lambda: _crypted_transfer(channel.asynchronous, payload, timeout)
+    )
+
+
+class ChannelPool(object):
+    """
+    A lazily filled set of idle ReqChannels to one master.
+
+    Channels are handed out one per caller and come back to the pool when the
+    caller is done with them. A channel that failed to send or sat idle for
+    longer than ``legion_channel_max_idle`` seconds is closed instead of
+    reused, so a master restart costs one reconnect rather than a dead pool.
+    """
+
+    def __init__(self, opts, crypt="aes"):
+        self.opts = opts
+        self.crypt = crypt
+        self.size = opts.get("legion_channel_pool_size", 10)
+        self.max_idle = opts.get("legion_channel_max_idle", 300)
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def reserve(self, count):
+        """
+        Keep up to ``count`` idle channels, for callers with that many in flight
+        """
+        with self._lock:
+            self.size = max(self.size, count)
+
+    def acquire(self):
+        """
+        Get a healthy channel out of the pool or create a new one
+        """
+        now = time.time()
+        with self._lock:
+            while self._idle:
+                channel, last_used = self._idle.pop()
+                if now - last_used < self.max_idle:
+                    return channel
+                self._close(channel)
+        return factory(self.opts, self.crypt)
+
+    def release(self, channel):
+        """
+        Hand a channel back to the pool
+        """
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((channel, time.time()))
+                return
+        self._close(channel)
+
+    def discard(self, channel):
+        """
+        Drop a channel that can no longer be trusted
+        """
+        self._close(channel)
+
+    @contextlib.contextmanager
+    def channel(self):
+        """
+        Borrow a channel for the duration of the with block
+        """
+        channel = self.acquire()
+        try:
+            yield channel
+        except Exception:
+            self.discard(channel)
+            raise
+        self.release(channel)
+
+    def send(self, load, **kwargs):
+        """
+        Send the load over a pooled channel, reconnecting once if the master
+        went away since the channel was last used
+        """
+        return self._call(lambda channel: channel.send(load, **kwargs))
+
+    def send_serialized(self, payload, timeout=30):
+        """
+        Send an already serialized load over a pooled channel
+        """
+        return self._call(
+            lambda channel: send_serialized(channel, payload, timeout=timeout)
+        )
+
+    def _call(self, func):
+        for attempt in range(2):
+            channel = self.acquire()
+            try:
+                ret = func(channel)
+            except (SaltClientError, SaltReqTimeoutError) as exc:
+                self.discard(channel)
+                if attempt:
+                    raise
+                log.debug("Reconnecting to the master after: %s", exc)
+                continue
+            except Exception:
+                # Whatever state the channel was left in, do not reuse it
+                self.discard(channel)
+                raise
+            self.release(channel)
+            return ret
+
+    def close(self):
+        """
+        Close all idle channels
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for channel, _ in idle:
+            self._close(channel)
+
+    @staticmethod
+    def _close(channel):
+        try:
+            channel.close()
+        except Exception as exc:  # pylint: disable=broad-except
+            log.debug("Failed to close channel: %s", exc)
+
+
+def get_pool(opts, crypt="aes"):
+    """
+    Return the pool of channels for this process to the master in ``opts``,
+    creating it on first use.
+
+    Pools are per process: a job process forked from the minion must not
+    reuse the sockets of its parent.
+    """
+    key = (os.getpid(), opts["id"], opts.get("master_uri"), crypt)
+    with _POOLS_LOCK:
+        pool = _POOLS.get(key)
+        if pool is None:
+            for stale in [k for k in _POOLS if k[0] != key[0]]:
+                del _POOLS[stale]
+            pool = _POOLS[key] = ChannelPool(opts, crypt)
+    return pool
+
+
+@atexit.register
+def close_pools():
+    """
+    Close every pool owned by this process
+    """
+    with _POOLS_LOCK:
+        pools = [pool for key, pool in _POOLS.items() if key[0] == os.getpid()]
+        _POOLS.clear()
+    for pool in pools:
+        pool.close()
@@ -0,0 +1,163 @@
+"""
+Key material cached for the life of the process, so signing and signing in on
+behalf of many fakes does not go back to disk for every one of them
+"""
+# Import python libs
+import os
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Import salt libs
+import salt.crypt
+import salt.utils.files
+import salt.utils.stringutils
+
+# Import third party libs
+try:
+    from M2Crypto import EVP, RSA
+
+    HAS_M2 = True
+except ImportError:
+    HAS_M2 = False
+
+if not HAS_M2:
+    try:
+        from Cryptodome.Cipher import PKCS1_OAEP
+        from Cryptodome.Hash import SHA
+        from Cryptodome.Signature import PKCS1_v1_5
+    except ImportError:
+        from Crypto.Cipher import PKCS1_OAEP
+        from Crypto.Hash import SHA
+        from Crypto.Signature import PKCS1_v1_5
+
+_KEYS = {}
+_MASTER_KEYS = {}
+_KEYS_LOCK = threading.Lock()
+
+
+def private_key(opts):
+    """
+    Return the minion's private key, loading it from the pki_dir only the first
+    time it is asked for in this process
+    """
+    path = os.path.join(opts["pki_dir"], "minion.pem")
+    with _KEYS_LOCK:
+        key = _KEYS.get(path)
+        if key is None:
+            key = _KEYS[path] = salt.crypt.get_rsa_key(path, None)
+    return key
+
+
+def sign(key, data):
+    """
+    Sign the serialized ``data`` the same way ``salt.crypt.sign_message`` does,
+    with an already loaded key
+    """
+    if HAS_M2:
+        md = EVP.MessageDigest("sha1")
+        md.update(data)
+        return key.sign(md.final())
+    return PKCS1_v1_5.new(key).sign(SHA.new(data))
+
+
+def sign_many(key, payloads, workers=1, chunk=None):
+    """
+    Sign a batch of serialized payloads, spread over ``workers`` threads.
+
+    The payloads are taken ``chunk`` at a time, ``workers`` by default, so
+    only that many of them are held in memory at once.
+    """
+    if workers <= 1:
+        return [sign(key, payload) for payload in payloads]
+    payloads = iter(payloads)
+    chunk = max(1, chunk or workers)
+    sigs = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch in iter(lambda: list(itertools.islice(payloads, chunk)), []):
+            sigs.extend(executor.map(lambda payload: sign(key, payload), batch))
+    return sigs
+
+
+def master_public_key(opts):
+    """
+    Return the master's public key cached by the minion, parsed the first time
+    it is asked for in this process and again only when the file changes
+    """
+    path = os.path.join(opts["pki_dir"], "minion_master.pub")
+    mtime = os.path.getmtime(path)
+    with _KEYS_LOCK:
+        cached = _MASTER_KEYS.get(path)
+        if cached is None or cached[0] != mtime:
+            cached = _MASTER_KEYS[path] = (mtime, salt.crypt.get_rsa_pub_key(path))
+    return cached[1]
+
+
+def encrypt(pub, data):
+    """
+    Encrypt ``data`` with the public key ``pub`` the way salt's ``_auth`` does
+    """
+    if HAS_M2:
+        return pub.public_encrypt(data, RSA.pkcs1_oaep_padding)
+    return PKCS1_OAEP.new(pub).encrypt(data)
+
+
+def decrypt(key, data):
+    """
+    Decrypt ``data`` encrypted with the public half of the private ``key``
+    """
+    if HAS_M2:
+        return key.private_decrypt(data, RSA.pkcs1_oaep_padding)
+    return PKCS1_OAEP.new(key).decrypt(data)
+
+
+def encrypt_token(pub):
+    """
+    Encrypt a new random token with the master's public key
+    """
+    token = salt.utils.stringutils.to_bytes(salt.crypt.Crypticle.generate_key_string())
+    return encrypt(pub, token)
+
+
+class SignInPayloads(object):
+    """
+    Build the ``_auth`` payloads fakes sign in to the master with.
+
+    The minion's public key and the master's public key are read once, when
+    the builder is made. With a ``tokens`` pool size the tokens are encrypted
+    up front and handed out in turn, so building a payload costs no RSA work
+    at all. Otherwise every payload gets a freshly encrypted token.
+    """
+
+    def __init__(self, opts, tokens=0):
+        with salt.utils.files.fopen(os.path.join(opts["pki_dir"], "minion.pub")) as f:
+            self.pub = f.read()
+        try:
+            self.master_pub = master_public_key(opts)
+        except Exception:  # pylint: disable=broad-except
+            self.master_pub = None
+        self.tokens = [
+            token for token in (self._token() for _ in range(tokens)) if token
+        ]
+        self._turn = itertools.count()
+
+    def _token(self):
+        if self.master_pub is None:
+            return None
+        try:
+            return encrypt_token(self.master_pub)
+        except Exception:  # pylint: disable=broad-except
+            return None
+
+    def __call__(self, id_):
+        """
+        Generates the payload used to authenticate ``id_`` with the master
+        """
+        payload = {"cmd": "_auth", "id": id_, "pub": self.pub}
+        if self.tokens:
+            token = self.tokens[next(self._turn) % len(self.tokens)]
+        else:
+            token = self._token()
+        if token is not None:
+            payload["token"] = token
+        return payload
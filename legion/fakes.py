@@ -0,0 +1,86 @@
+"""
+The fake minions a legion minion stands in for
+"""
+# Import python libs
+import os
+
+# Import legion libs
+import legion.grains
+
+# The name of the file in the minion's cachedir that overrides how many of
+# its fakes are active
+ACTIVE_FILE = "legion_active"
+
+_ACTIVE = {}
+
+
+def active_path(opts):
+    """
+    Return the path of the minion's active fakes override
+    """
+    return os.path.join(opts["cachedir"], ACTIVE_FILE)
+
+
+def active_count(opts):
+    """
+    Return how many of the minion's fakes are active: the number in its
+    override file when there is one, capped at ``legion_fakes``. The file is
+    read again only when it changes.
+    """
+    count = opts.get("legion_fakes", 10)
+    path = active_path(opts)
+    try:
+        mtime = os.path.getmtime(path)
+    except (OSError, KeyError):
+        return count
+    cached = _ACTIVE.get(path)
+    if cached is None or cached[0] != mtime:
+        try:
+            with open(path) as fp_:
+                cached = _ACTIVE[path] = (mtime, int(fp_.read().strip()))
+        except (IOError, OSError, ValueError):
+            return count
+    return max(0, min(count, cached[1]))
+
+
+def set_active(opts, count):
+    """
+    Switch the minion to ``count`` active fakes
+    """
+    path = active_path(opts)
+    if not os.path.exists(opts["cachedir"]):
+        os.makedirs(opts["cachedir"])
+    with open(path + ".tmp", "w") as fp_:
+        fp_.write(str(count))
+    os.rename(path + ".tmp", path)
+
+
+def fake_ids(opts, active=True):
+    """
+    Return the ids of the fakes of the minion, only the active ones unless
+    ``active`` is False
+    """
+    count = active_count(opts) if active else opts.get("legion_fakes", 10)
+    return ["{}_{}".format(opts["id"], ind) for ind in range(count)]
+
+
+def fake_opts(opts, id_):
+    """
+    Return the opts of the fake ``id_``: the minion's opts with the fake's id
+    and grains. Only the top level is copied, so this is cheap enough to do
+    for every fake on every publish.
+    """
+    fopts = dict(opts)
+    fopts["id"] = fopts["minion_id"] = id_
+    fopts["grains"] = grains(opts, opts.get("grains", {}), id_)
+    # A fake has no fakes of its own to widen its targeting to
+    fopts["legion_targeting"] = False
+    return fopts
+
+
+def grains(opts, base, id_):
+    """
+    Return the grains of the fake ``id_``, made from the minion's ``base``
+    grains and the grains named in ``legion_rand_grains``
+    """
+    return legion.grains.fake_grains(base, id_, opts.get("legion_rand_grains", ()))
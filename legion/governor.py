@@ -0,0 +1,196 @@
+"""
+Divide a total number of minion ids between the minions of a swarm and their
+fakes, moving fakes off the minions the host cannot keep up with
+"""
+# Import python libs
+from __future__ import absolute_import, print_function
+import os
+import math
+import time
+
+# Import legion libs
+import legion.fakes
+import legion.proc
+import legion.stats
+
+
+def plan_swarm(total, cap, spare):
+    """
+    Return how many minions a swarm of ``total`` ids needs with at most
+    ``cap`` fakes a minion, plus ``spare`` of them to move fakes to
+    """
+    return max(1, int(math.ceil(total / float(cap + 1) * (1 + spare))))
+
+
+class Governor(object):
+    """
+    Keep the number of active fakes of every minion of the swarm, and move
+    them off the minions that go over a limit:
+
+    max_rss
+        the resident memory in bytes of the minion and its job processes
+    max_cpu
+        the share of a core the minion and its job processes use
+    max_send
+        the 99th percentile in seconds of the minion's return sends
+
+    A minion over a limit gives up ``shed`` of its active fakes and takes no
+    more from then on. The fakes it gave up go to the other minions, up to
+    ``cap`` fakes each. Whatever no minion can take is left out, so the swarm
+    settles at the most ids the host sustains, ``total`` at best.
+
+    Every minion's active fakes are written to the override file in its
+    cachedir, which its fakes pick up on the next job.
+    """
+
+    def __init__(
+        self,
+        confs,
+        total,
+        cap,
+        stats_dir,
+        pid_of,
+        max_rss=0,
+        max_cpu=0.0,
+        max_send=0.0,
+        shed=0.2,
+    ):
+        self.confs = confs
+        self.total = total
+        self.cap = cap
+        self.stats_dir = stats_dir
+        self.pid_of = pid_of
+        self.max_rss = max_rss
+        self.max_cpu = max_cpu
+        self.max_send = max_send
+        self.shed = shed
+        self.active = {}
+        self.saturated = set()
+        self.dropped = 0
+        self._cpu = {}
+        self._sends = {}
+
+    def plan(self):
+        """
+        Spread the fakes of the total evenly over the minions
+        """
+        fakes = max(0, self.total - len(self.confs))
+        base, extra = divmod(fakes, len(self.confs))
+        for idx, conf in enumerate(self.confs):
+            self.set_active(conf, min(self.cap, base + (1 if idx < extra else 0)))
+        self.dropped = max(0, fakes - sum(self.active.values()))
+
+    def set_active(self, conf, count):
+        """
+        Switch the minion of ``conf`` to ``count`` active fakes
+        """
+        self.active[conf["id"]] = count
+        legion.fakes.set_active(
+            {"cachedir": os.path.join(conf["path"], "cache")}, count
+        )
+
+    def sample(self, conf, sends):
+        """
+        Return which limits the minion of ``conf`` is over
+        """
+        over = []
+        pid = self.pid_of(conf)
+        if pid:
+            if self.max_rss and legion.proc.process_rss(pid) > self.max_rss:
+                over.append("rss")
+            now, cpu = time.time(), legion.proc.process_cpu(pid)
+            last = self._cpu.get(conf["id"])
+            self._cpu[conf["id"]] = (now, cpu)
+            if self.max_cpu and last and now > last[0]:
+                if (cpu - last[1]) / (now - last[0]) > self.max_cpu:
+                    over.append("cpu")
+        hist = sends.get(conf["id"])
+        if self.max_send and hist is not None:
+            recent = hist.since(self._sends.get(conf["id"], legion.stats.Histogram()))
+            self._sends[conf["id"]] = hist
+            if recent.count and recent.quantile(0.99) > self.max_send:
+                over.append("send")
+        return over
+
+    def step(self):
+        """
+        Sample every minion and move fakes off those over a limit. Returns
+        whether any fakes moved.
+        """
+        owners = legion.stats.collect_by_owner(self.stats_dir)
+        sends = dict(
+            (owner, histograms["return_send"])
+            for owner, (_, histograms) in owners.items()
+            if "return_send" in histograms
+        )
+        freed = 0
+        for conf in self.confs:
+            over = self.sample(conf, sends)
+            active = self.active[conf["id"]]
+            if not over or not active:
+                continue
+            shed = max(1, int(math.ceil(active * self.shed)))
+            print(
+                "{0} is over its {1} limit, moving {2} of its {3} fakes".format(
+                    conf["id"], " and ".join(over), shed, active
+                )
+            )
+            self.saturated.add(conf["id"])
+            self.set_active(conf, active - shed)
+            freed += shed
+        if not freed:
+            return False
+        takers = [
+            conf
+            for conf in self.confs
+            if conf["id"] not in self.saturated and self.active[conf["id"]] < self.cap
+        ]
+        takers.sort(key=lambda conf: self.active[conf["id"]])
+        for idx, conf in enumerate(takers):
+            share = int(math.ceil(freed / float(len(takers) - idx)))
+            take = min(share, self.cap - self.active[conf["id"]])
+            if take:
+                self.set_active(conf, self.active[conf["id"]] + take)
+                freed -= take
+        self.dropped += freed
+        return True
+
+    def run(self, interval, rounds, probe=None, max_rounds=30):
+        """
+        Sample every ``interval`` seconds, after running ``probe`` to put load
+        on the minions, until no fakes moved for ``rounds`` rounds in a row
+        """
+        calm = 0
+        for _ in range(max_rounds):
+            if probe is not None:
+                probe()
+            time.sleep(interval)
+            if self.step():
+                calm = 0
+            else:
+                calm += 1
+                if calm >= rounds:
+                    break
+        self.report()
+
+    def report(self):
+        """
+        Print the split the governor settled on
+        """
+        counts = list(self.active.values())
+        ids = len(counts) + sum(counts)
+        print(
+            "Split {0} ids over {1} minions with {2} to {3} fakes each "
+            "({4:.1f} on average), {5} minions saturated".format(
+                ids,
+                len(counts),
+                min(counts),
+                max(counts),
+                sum(counts) / float(len(counts)),
+                len(self.saturated),
+            )
+        )
+        if ids < self.total:
+            print(
+                "The host sustains {0} of the {1} ids asked for".format(ids, self.total)
+            )
@@ -0,0 +1,51 @@
+"""
+Grains synthesized for every fake from its id, so a fake gets the same grains
+every time they are asked for without them being stored anywhere
+"""
+# Import python libs
+import uuid
+import random
+import hashlib
+
+OSES = [
+    "Arch",
+    "Ubuntu",
+    "Debian",
+    "CentOS",
+    "Fedora",
+    "Gentoo",
+    "AIX",
+    "Solaris",
+]
+VERS = [
+    "2014.1.6",
+    "2014.7.4",
+    "2015.5.5",
+    "2015.8.0",
+]
+# The grains that can be synthesized, in the order they are drawn
+RAND_GRAINS = ("os", "saltversion", "machine_id", "uuid")
+
+
+def fake_grains(grains, id_, rand=()):
+    """
+    Return the grains of the fake ``id_``: the minion's ``grains`` with the
+    fake's id, and a value seeded by the id for every grain named in ``rand``
+    """
+    fgrains = dict(grains, id=id_)
+    if not rand:
+        return fgrains
+    bid = id_.encode("utf-8")
+    rng = random.Random(hashlib.sha256(bid).digest())
+    # Draw every grain, picked or not, so a grain's value does not depend on
+    # which other grains are synthesized
+    values = {
+        "os": rng.choice(OSES),
+        "saltversion": rng.choice(VERS),
+        "machine_id": hashlib.md5(bid).hexdigest(),
+        "uuid": str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+    }
+    for name in rand:
+        if name in values:
+            fgrains[name] = values[name]
+    return fgrains
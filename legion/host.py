@@ -0,0 +1,168 @@
+"""
+Host many minion identities in a few worker processes, each running its
+minions on one IO loop, instead of one salt-minion daemon per minion
+"""
+# Import python libs
+import os
+import time
+import logging
+import itertools
+import threading
+import multiprocessing
+
+# Import salt libs
+import salt.config
+import salt.minion
+from salt.exceptions import SaltClientError
+
+# Import third party libs
+try:
+    import salt.ext.tornado.gen as tornado_gen
+    import salt.ext.tornado.ioloop as tornado_ioloop
+except ImportError:
+    import tornado.gen as tornado_gen
+    import tornado.ioloop as tornado_ioloop
+
+log = logging.getLogger(__name__)
+
+
+class MinionHost(object):
+    """
+    A worker process's set of minions, sharing its imports, its loaded keys
+    and its IO loop. Every minion still signs in and subscribes to the
+    master's publishes on its own.
+
+    The config directories of the minions to start come in over ``conn``,
+    ``None`` stops the host.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.minions = []
+        self.io_loop = None
+
+    def run(self):
+        """
+        Run the minions until told to stop
+        """
+        self.io_loop = tornado_ioloop.IOLoop()
+        self.io_loop.make_current()
+        self.io_loop.add_handler(
+            self.conn.fileno(), self._on_conn, tornado_ioloop.IOLoop.READ
+        )
+        self.io_loop.start()
+
+    def _on_conn(self, fd, events):
+        while self.conn.poll():
+            try:
+                path = self.conn.recv()
+            except EOFError:
+                path = None
+            if path is None:
+                self.io_loop.remove_handler(fd)
+                for minion in self.minions:
+                    minion.destroy()
+                self.io_loop.stop()
+                return
+            self.spawn(path)
+
+    def spawn(self, path):
+        """
+        Load the config in the directory ``path`` and bring its minion up
+        """
+        opts = salt.config.minion_config(os.path.join(path, "minion"))
+        minion = salt.minion.Minion(
+            opts,
+            opts["auth_timeout"],
+            False,
+            io_loop=self.io_loop,
+            loaded_base_name="salt.loader.{0}".format(opts["id"]),
+        )
+        self.io_loop.spawn_callback(self._connect, minion)
+
+    @tornado_gen.coroutine
+    def _connect(self, minion):
+        auth_wait = minion.opts["acceptance_wait_time"]
+        failed = False
+        while True:
+            try:
+                yield minion.connect_master(failed=failed)
+                minion.tune_in(start=False)
+                self.minions.append(minion)
+                return
+            except SaltClientError as exc:
+                failed = True
+                log.error(
+                    "Minion %s failed to connect to the master, retrying in %ss: %s",
+                    minion.opts["id"],
+                    auth_wait,
+                    exc,
+                )
+                auth_wait = min(
+                    auth_wait + minion.opts["acceptance_wait_time"],
+                    minion.opts["acceptance_wait_time_max"]
+                    or minion.opts["acceptance_wait_time"],
+                )
+                yield tornado_gen.sleep(auth_wait)
+            except Exception:  # pylint: disable=broad-except
+                log.exception("Minion %s failed to start", minion.opts["id"])
+                return
+
+
+def run_host(conn, log_file):
+    """
+    The target of a worker process
+    """
+    logging.basicConfig(
+        filename=log_file,
+        level=logging.WARNING,
+        format="%(asctime)s [%(name)s][%(levelname)s] %(message)s",
+    )
+    MinionHost(conn).run()
+
+
+class HostPool(object):
+    """
+    The worker processes hosting the minions of a swarm. Minions are handed
+    to the workers in turn.
+    """
+
+    def __init__(self, workers, log_dir):
+        self.conns = []
+        self.procs = []
+        self._lock = threading.Lock()
+        self._turn = itertools.count()
+        for idx in range(max(1, workers)):
+            reader, writer = multiprocessing.Pipe(duplex=False)
+            proc = multiprocessing.Process(
+                target=run_host,
+                args=(reader, os.path.join(log_dir, "host-{0}.log".format(idx))),
+            )
+            proc.daemon = True
+            proc.start()
+            reader.close()
+            self.conns.append(writer)
+            self.procs.append(proc)
+
+    def start(self, path):
+        """
+        Start the minion whose config is in the directory ``path``
+        """
+        with self._lock:
+            self.conns[next(self._turn) % len(self.conns)].send(path)
+
+    def stop(self, timeout=10):
+        """
+        Stop every worker and its minions
+        """
+        with self._lock:
+            for conn in self.conns:
+                try:
+                    conn.send(None)
+                except (IOError, OSError):
+                    pass
+        deadline = time.time() + timeout
+        for proc in self.procs:
+            proc.join(max(0, deadline - time.time()))
+            if proc.is_alive():
+                proc.terminate()
@@ -18,10 +18,13 @@ import tempfile
 import shutil
 import sys
 import hashlib
+import json
 import uuid
+import threading
 import multiprocessing
 
 from shutil import copyfile
+from concurrent.futures import ThreadPoolExecutor
 
 # Import salt libs
 import salt
@@ -33,6 +36,20 @@ import salt.utils.platform
 import salt.utils.yaml
 import salt.utils.event
 
+# Import legion libs
+import legion.bench
+import legion.governor
+import legion.grains
+import legion.host
+import legion.microbench
+import legion.pacing
+import legion.proc
+import legion.readiness
+import legion.state
+import legion.sweep
+import legion.timing
+import legion.stats
+
 # Import third party libs
 from salt.ext import six
 from salt.ext.six.moves import range  # pylint: disable=import-error,redefined-builtin
@@ -42,44 +59,107 @@ if salt.utils.platform.is_windows():
 else:
     import pwd
 
-OSES = [
-    "Arch",
-    "Ubuntu",
-    "Debian",
-    "CentOS",
-    "Fedora",
-    "Gentoo",
-    "AIX",
-    "Solaris",
-]
-VERS = [
-    "2014.1.6",
-    "2014.7.4",
-    "2015.5.5",
-    "2015.8.0",
+# The cli option that randomizes each grain
+RAND_OPTS = {
+    "os": "rand_os",
+    "saltversion": "rand_ver",
+    "machine_id": "rand_machine_id",
+    "uuid": "rand_uuid",
+}
+# The minion config keys that differ per minion
+MINION_KEYS = ("id", "cachedir", "log_file", "grains", "pki_dir")
+# The modules a --lean minion keeps when --keep-modules is not given
+LEAN_MODULES = (
+    "cmd",
+    "config",
+    "event",
+    "grains",
+    "legion",
+    "network",
+    "pillar",
+    "saltutil",
+    "sys",
+    "test",
+)
+# The modules a minion keeps whatever --keep-modules says
+LEAN_REQUIRED = ("legion", "saltutil")
+# The grain collectors a --lean minion skips
+LEAN_DISABLED_GRAINS = [
+    "chronos",
+    "cimc",
+    "disks",
+    "esxi",
+    "extra",
+    "fibre_channel",
+    "fx2",
+    "iscsi",
+    "junos",
+    "lvm",
+    "marathon",
+    "mdadm",
+    "mdata",
+    "metadata",
+    "minion_process",
+    "napalm",
+    "nvme",
+    "nxos",
+    "opts",
+    "panos",
+    "philips_hue",
+    "rest_sample",
+    "smartos",
+    "ssh_sample",
+    "zfs",
 ]
 
 
-def event_listener(accepted_minions, cached_ret):
-    opts = salt.config.client_config("/etc/salt/master")
-    event = salt.utils.event.get_event(
-        "master", sock_dir=opts["sock_dir"], transport=opts["transport"], opts=opts
+def master_event(opts=None):
+    """
+    Connect to the master's event bus
+    """
+    if opts is None:
+        opts = salt.config.client_config("/etc/salt/master")
+    return salt.utils.event.get_event(
+        "master",
+        sock_dir=opts["sock_dir"],
+        transport=opts["transport"],
+        opts=opts,
+        listen=True,
     )
 
+
+def iter_events(opts=None, event=None):
+    """
+    Yield the tag and data of every event on the master's event bus, blocking
+    until the next one arrives. Pass an ``event`` connected with
+    ``master_event`` to not miss the events fired before the first one is
+    asked for.
+    """
+    if event is None:
+        event = master_event(opts)
     while 1:
-        data = event.get_event()
-        if data:
-            if "act" in data:
-                mid = data["id"]
-                if mid not in accepted_minions:
-                    accepted_minions[mid] = True
+        ret = event.get_event(wait=5, full=True, auto_reconnect=True)
+        if ret:
+            yield ret["tag"], ret["data"]
 
-            elif "return" in data and "fun" in data and data["fun"] == "legion.cache":
-                mid = data["id"]
-                if mid not in cached_ret:
-                    cached_ret[mid] = True
 
-        time.sleep(0.1)
+def event_listener(readiness):
+    """
+    Watch the master's events for minions signing in and returning their
+    legion cache, and mark each of them in the shared ``readiness``
+    """
+    for tag, data in iter_events():
+        if tag.startswith("salt/auth"):
+            attr = "accepted_minions"
+        elif tag.startswith("salt/job/") and data.get("fun") == "legion.cache":
+            if "return" not in data:
+                continue
+            attr = "cached_ret"
+        else:
+            continue
+        mid = data.get("id")
+        if mid is not None:
+            readiness.mark(attr, mid)
 
 
 def this_user():
@@ -112,6 +192,65 @@ def parse():
         type="int",
         help="The number of minions to make",
     )
+    parser.add_option(
+        "--total",
+        dest="total",
+        default=0,
+        type="int",
+        help=(
+            "The number of minion ids to bring up, minions and fakes together. "
+            "The swarm picks the number of minions from it and --legion, the "
+            "most fakes per minion (100 by default). Once all minions are up "
+            "it probes them and moves fakes off the minions that go over "
+            "--max-rss, --max-cpu or --max-send. Needs --run-modules, and "
+            "does not work with --in-process"
+        ),
+    )
+    parser.add_option(
+        "--spare",
+        dest="spare",
+        default=0.2,
+        type="float",
+        help="The share of extra minions --total starts to move fakes to",
+    )
+    parser.add_option(
+        "--max-rss",
+        dest="max_rss",
+        default=512,
+        type="int",
+        help="The MiB of memory a minion may use with --total, 0 for no limit",
+    )
+    parser.add_option(
+        "--max-cpu",
+        dest="max_cpu",
+        default=90,
+        type="float",
+        help="The percent of a core a minion may use with --total, 0 for no limit",
+    )
+    parser.add_option(
+        "--max-send",
+        dest="max_send",
+        default=1.0,
+        type="float",
+        help=(
+            "The seconds the 99th percentile of a minion's return sends may "
+            "take with --total, 0 for no limit"
+        ),
+    )
+    parser.add_option(
+        "--govern-interval",
+        dest="govern_interval",
+        default=10.0,
+        type="float",
+        help="Seconds between the samples of the minions with --total",
+    )
+    parser.add_option(
+        "--govern-rounds",
+        dest="govern_rounds",
+        default=3,
+        type="int",
+        help="Samples in a row without moving fakes that make the swarm stable",
+    )
     parser.add_option(
         "-M",
         action="store_true",
@@ -141,35 +280,66 @@ def parse():
         dest="rand_os",
         default=False,
         action="store_true",
-        help="Each Minion claims a different os grain",
+        help="Each Minion and legion fake claims a different os grain",
     )
     parser.add_option(
         "--rand-ver",
         dest="rand_ver",
         default=False,
         action="store_true",
-        help="Each Minion claims a different version grain",
+        help="Each Minion and legion fake claims a different version grain",
     )
     parser.add_option(
         "--rand-machine-id",
         dest="rand_machine_id",
         default=False,
         action="store_true",
-        help="Each Minion claims a different machine id grain",
+        help="Each Minion and legion fake claims a different machine id grain",
     )
     parser.add_option(
         "--rand-uuid",
         dest="rand_uuid",
         default=False,
         action="store_true",
-        help="Each Minion claims a different UUID grain",
+        help="Each Minion and legion fake claims a different UUID grain",
     )
     parser.add_option(
         "-k",
         "--keep-modules",
         dest="keep",
         default="",
-        help="A comma delimited list of modules to enable",
+        help="A comma delimited list of modules to enable, legion and saltutil "
+        "are always kept",
+    )
+    parser.add_option(
+        "--lean",
+        dest="lean",
+        default=False,
+        action="store_true",
+        help=(
+            "Run the minions with a light profile: only the --keep-modules "
+            "(or a minimal set of) modules, no optional grain collectors, "
+            "jobs in threads, a shared extension module directory and no "
+            "module syncing"
+        ),
+    )
+    parser.add_option(
+        "--in-process",
+        dest="in_process",
+        default=False,
+        action="store_true",
+        help=(
+            "Host the minions inside a few worker processes, each running "
+            "many minions on one IO loop, instead of one salt-minion daemon "
+            "per minion"
+        ),
+    )
+    parser.add_option(
+        "--workers",
+        dest="workers",
+        default=multiprocessing.cpu_count(),
+        type="int",
+        help="The number of worker processes hosting minions with --in-process",
     )
     parser.add_option(
         "-f",
@@ -193,6 +363,17 @@ def parse():
         default=False,
         help="Don't cleanup temporary files/directories",
     )
+    parser.add_option(
+        "--resume",
+        dest="resume",
+        default=False,
+        action="store_true",
+        help=(
+            "Pick up the swarm left in --temp-dir by an earlier run, skipping "
+            "the minions already configured, keyed and cached with the same "
+            "options. Implies --no-clean"
+        ),
+    )
     parser.add_option(
         "--root-dir",
         dest="root_dir",
@@ -219,6 +400,180 @@ def parse():
         type="float",
         help="Seconds to wait to issue legion commands",
     )
+    parser.add_option(
+        "--ramp-profile",
+        dest="ramp_profile",
+        default="constant",
+        type="choice",
+        choices=legion.pacing.PROFILES,
+        help=(
+            "The shape minion starts follow on their way to --ramp-rate: "
+            "{0}".format(", ".join(legion.pacing.PROFILES))
+        ),
+    )
+    parser.add_option(
+        "--ramp-rate",
+        dest="ramp_rate",
+        default=0.0,
+        type="float",
+        help="Minion starts a second once ramped up, 0 for no limit",
+    )
+    parser.add_option(
+        "--ramp-time",
+        dest="ramp_time",
+        default=0.0,
+        type="float",
+        help="Seconds it takes to ramp up to --ramp-rate",
+    )
+    parser.add_option(
+        "--ramp-steps",
+        dest="ramp_steps",
+        default=4,
+        type="int",
+        help="The number of steps of the stepped and exponential ramps",
+    )
+    parser.add_option(
+        "--legion-ramp-profile",
+        dest="legion_ramp_profile",
+        default=None,
+        type="choice",
+        choices=legion.pacing.PROFILES,
+        help="The shape fake key registration and cache warm-up follow",
+    )
+    parser.add_option(
+        "--legion-ramp-rate",
+        dest="legion_ramp_rate",
+        default=0.0,
+        type="float",
+        help="Fake sign ins and pillar compiles a second per minion once ramped up",
+    )
+    parser.add_option(
+        "--legion-ramp-time",
+        dest="legion_ramp_time",
+        default=0.0,
+        type="float",
+        help="Seconds it takes to ramp up to --legion-ramp-rate",
+    )
+    parser.add_option(
+        "--legion-targeting",
+        dest="legion_targeting",
+        default=False,
+        action="store_true",
+        help=(
+            "Match every publish against the legion fakes so only targeted "
+            "fakes return, and minions run jobs only their fakes are targeted by"
+        ),
+    )
+    parser.add_option(
+        "--start-window",
+        dest="start_window",
+        default=1,
+        type="int",
+        help="The number of minions to start and wait for at once",
+    )
+    parser.add_option(
+        "--keys-window",
+        dest="keys_window",
+        default=1,
+        type="int",
+        help="The number of minions to run legion.keys on at once",
+    )
+    parser.add_option(
+        "--cache-window",
+        dest="cache_window",
+        default=1,
+        type="int",
+        help="The number of minions to run legion.cache on at once",
+    )
+    parser.add_option(
+        "--legion-window",
+        dest="legion_window",
+        default=1,
+        type="int",
+        help="The number of fake returns each minion keeps in flight at once",
+    )
+    parser.add_option(
+        "--return-model",
+        dest="return_model",
+        default="burst",
+        type="choice",
+        choices=legion.timing.MODELS,
+        help=(
+            "When the fakes return after their job: {0}".format(
+                ", ".join(legion.timing.MODELS)
+            )
+        ),
+    )
+    parser.add_option(
+        "--return-delay",
+        dest="return_delay",
+        default=0.0,
+        type="float",
+        help="Seconds after their job the fakes return, before any jitter",
+    )
+    parser.add_option(
+        "--return-jitter",
+        dest="return_jitter",
+        default=0.0,
+        type="float",
+        help=(
+            "The most seconds the uniform jitter adds to --return-delay, or the "
+            "median of the lognormal jitter"
+        ),
+    )
+    parser.add_option(
+        "--return-sigma",
+        dest="return_sigma",
+        default=1.0,
+        type="float",
+        help="The shape of the lognormal jitter",
+    )
+    parser.add_option(
+        "--return-slow-pct",
+        dest="return_slow_pct",
+        default=0.0,
+        type="float",
+        help="The percentage of fakes that return --return-slow-delay seconds late",
+    )
+    parser.add_option(
+        "--return-slow-delay",
+        dest="return_slow_delay",
+        default=0.0,
+        type="float",
+        help="Seconds the slow fakes return late",
+    )
+    parser.add_option(
+        "--return-drop-pct",
+        dest="return_drop_pct",
+        default=0.0,
+        type="float",
+        help="The percentage of fakes that do not return at all",
+    )
+    parser.add_option(
+        "--stats-interval",
+        dest="stats_interval",
+        default=10.0,
+        type="float",
+        help="Seconds between updates of the Prometheus textfile",
+    )
+    parser.add_option(
+        "--prometheus-file",
+        dest="prometheus_file",
+        default=None,
+        help=(
+            "The Prometheus textfile the phase latencies and counters of the "
+            "swarm are written to, legion.prom in the swarm directory by default"
+        ),
+    )
+    parser.add_option(
+        "--stats-report",
+        dest="stats_report",
+        default="legion-stats.json",
+        help=(
+            "The JSON file the phase latencies and counters of the swarm are "
+            "written to at shutdown"
+        ),
+    )
     parser.add_option(
         "-c",
         "--config-dir",
@@ -238,7 +593,44 @@ def parse():
         default=False,
     )
 
+    parser.add_option(
+        "--preseed-keys",
+        dest="preseed_keys",
+        default=False,
+        action="store_true",
+        help=(
+            "Write the keys of all minions and legion fakes straight into the "
+            "master's accepted keys before the minions start. This requires "
+            "legion to be ran on the salt master that they are connecting to."
+        ),
+    )
+    parser.add_option(
+        "--master-pki-dir",
+        dest="master_pki_dir",
+        default="/etc/salt/pki/master",
+        help="The pki_dir of the master to pre-seed the keys into",
+    )
+
     options, _args = parser.parse_args()
+    if options.total:
+        if options.in_process:
+            # The workers share their memory and CPU between many minions
+            parser.error("--total samples every minion process, not --in-process")
+        if not options.run_modules:
+            parser.error("--total needs --run-modules to probe the minions")
+        options.legion = options.legion or 100
+        options.minions = legion.governor.plan_swarm(
+            options.total, options.legion, options.spare
+        )
+        print(
+            "Planning {0} minions with up to {1} fakes each for {2} ids".format(
+                options.minions, options.legion, options.total
+            )
+        )
+    if options.resume:
+        if not options.temp_dir:
+            parser.error("--resume needs the --temp-dir of the swarm to resume")
+        options.no_clean = True
 
     opts = {}
 
@@ -253,10 +645,9 @@ class Swarm(object):
     Create a swarm of minions
     """
 
-    def __init__(self, opts, accepted_minions, cached_ret):
+    def __init__(self, opts, readiness):
         self.opts = opts
-        self.accepted_minions = accepted_minions
-        self.cached_ret = cached_ret
+        self.readiness = readiness
 
         # If given a temp_dir, use it for temporary files
         if opts["temp_dir"]:
@@ -270,13 +661,21 @@ class Swarm(object):
             self.swarm_root = tempfile.mkdtemp(
                 prefix="mswarm-root", suffix=".d", dir=tmpdir
             )
+            # The minion and master swarms live in the same root
+            opts["temp_dir"] = self.swarm_root
 
         if self.opts["transport"] == "zeromq":
             self.pki = self._pki_dir()
+        self.stats_dir = os.path.join(self.swarm_root, "stats")
+        self.stats = legion.stats.get({"legion_stats_dir": self.stats_dir})
         self.zfill = len(str(self.opts["minions"]))
 
         self.confs = []
         self.minions = []
+        self.hosts = None
+        self.state = None
+        self.governor = None
+        self._shared_config = None
 
         random.seed(0)
 
@@ -309,10 +708,15 @@ class Swarm(object):
         if self.opts["master_too"]:
             print("Starting master...")
             master_swarm = MasterSwarm(self.opts)
+            self.opts["master_pki_dir"] = master_swarm.pki_dir
             master_swarm.start()
 
+        thread = threading.Thread(target=self.export_stats)
+        thread.daemon = True
+        thread.start()
+
         print("Starting minions...")
-        minions = MinionSwarm(self.opts, self.accepted_minions, self.cached_ret)
+        minions = self.minion_swarm = MinionSwarm(self.opts, self.readiness)
         minions.start_minions()
 
         print("All {0} minions have started.".format(self.opts["minions"]))
@@ -325,11 +729,52 @@ class Swarm(object):
                 self.clean_configs()
                 break
 
+    def export_stats(self):
+        """
+        Keep the Prometheus textfile up to date with the stats of the swarm
+        """
+        path = self.opts["prometheus_file"] or os.path.join(
+            self.swarm_root, "legion.prom"
+        )
+        while True:
+            time.sleep(self.opts["stats_interval"])
+            self.stats.flush()
+            try:
+                legion.stats.write_atomic(
+                    path, legion.stats.prometheus(*legion.stats.collect(self.stats_dir))
+                )
+            except (IOError, OSError) as exc:
+                print("Failed to write {0}: {1}".format(path, exc))
+
+    def report_stats(self):
+        """
+        Write the stats of the whole swarm to the JSON report and print how
+        long every phase took
+        """
+        self.stats.flush()
+        report = legion.stats.report(*legion.stats.collect(self.stats_dir))
+        if not report["phases"] and not report["counters"]:
+            return
+        for phase, val in sorted(report["phases"].items()):
+            print(
+                "{0}: {1} in {2:.3f}s mean, {3:.3f}s p50, {4:.3f}s p99, "
+                "{5:.3f}s max".format(
+                    phase, val["count"], val["mean"], val["p50"], val["p99"], val["max"]
+                )
+            )
+        with salt.utils.files.fopen(self.opts["stats_report"], "w") as fp_:
+            json.dump(report, fp_, indent=2, sort_keys=True)
+        print("Stats written to {0}".format(self.opts["stats_report"]))
+
     def shutdown(self):
         """
         Tear it all down
         """
+        self.report_stats()
         print("Killing any remaining running minions")
+        minion_swarm = getattr(self, "minion_swarm", None)
+        if minion_swarm is not None and minion_swarm.hosts is not None:
+            minion_swarm.hosts.stop()
         with open(os.devnull, "w") as stdout:
             subprocess.call(
                 'pkill -KILL -f "python.*salt-minion"', shell=True, stdout=stdout,
@@ -386,124 +831,500 @@ class MinionSwarm(Swarm):
         #     copyfile(returner, returner_dst)
         #     copyfile(module, module_dst)
 
+        self.state = legion.state.SwarmState(self.swarm_root, self.opts["resume"])
+        if self.opts["resume"]:
+            print(
+                "Resuming the swarm in {0}: {1} minions configured, {2} keyed, "
+                "{3} cached".format(
+                    self.swarm_root,
+                    self.state.count("config"),
+                    self.state.count("keys"),
+                    self.state.count("cache"),
+                )
+            )
         self.prep_configs()
-        for conf in self.confs:
-            path = conf["path"]
-            cmd = "salt-minion -c {0} --pid-file {1}".format(
-                path, "{0}.pid".format(path)
+        if self.opts["total"]:
+            self.governor = legion.governor.Governor(
+                self.confs,
+                self.opts["total"],
+                self.opts["legion"],
+                self.stats_dir,
+                self.minion_pid,
+                max_rss=self.opts["max_rss"] * 2 ** 20,
+                max_cpu=self.opts["max_cpu"] / 100.0,
+                max_send=self.opts["max_send"],
             )
+            self.governor.plan()
+        if self.opts["preseed_keys"]:
+            self.preseed_keys()
+
+        self.launch_ramp = legion.pacing.Ramp(
+            self.opts["ramp_profile"],
+            self.opts["ramp_rate"],
+            self.opts["ramp_time"],
+            self.opts["ramp_steps"],
+            seed=0,
+        )
+        stages = [("start", self.opts["start_window"], self.start_minion)]
+        if self.opts["legion"] and self.opts["run_modules"]:
+            if not self.opts["preseed_keys"]:
+                stages.append(("keys", self.opts["keys_window"], self.run_keys))
+            stages.append(("cache", self.opts["cache_window"], self.run_cache))
+        self.startups = []
+        if self.opts["in_process"]:
+            self.hosts = legion.host.HostPool(self.opts["workers"], self.swarm_root)
+        self.run_pipeline(stages)
+        self.state.save(force=True)
+        self.report_startups()
+        if self.governor is not None:
+            self.governor.run(
+                self.opts["govern_interval"],
+                self.opts["govern_rounds"],
+                probe=self.probe,
+            )
+
+    def report_startups(self):
+        """
+        Print how long the minions took to start and sign in, and how much
+        memory they use
+        """
+        if not self.startups:
+            return
+        times = [elapsed for elapsed, _ in self.startups]
+        rss = [rss for _, rss in self.startups if rss]
+        print(
+            "Minion startup ({0} profile): {1:.2f}s average, {2:.2f}s max".format(
+                "lean" if self.opts["lean"] else "full",
+                sum(times) / len(times),
+                max(times),
+            )
+        )
+        if rss:
+            print(
+                "Minion memory: {0:.1f} MiB average, {1:.1f} MiB max".format(
+                    sum(rss) / len(rss) / 2 ** 20, max(rss) / 2 ** 20
+                )
+            )
+        if self.hosts is not None:
+            rss = sum(legion.proc.process_rss(proc.pid) for proc in self.hosts.procs)
+            print(
+                "Minion memory: {0:.1f} MiB average over {1} worker processes".format(
+                    rss / len(self.startups) / 2 ** 20, len(self.hosts.procs)
+                )
+            )
+
+    def run_pipeline(self, stages):
+        """
+        Push every minion through the stages in order, with up to a stage's
+        window of minions in that stage at once, so waiting on one minion
+        overlaps with starting the next
+        """
+        done = dict((name, 0) for name, _, _ in stages)
+        failed = []
+        remaining = [len(self.confs)]
+        cond = threading.Condition()
+        executors = [
+            ThreadPoolExecutor(max_workers=max(1, window)) for _, window, _ in stages
+        ]
+
+        def _run(idx, conf):
+            name, _, func = stages[idx]
+            try:
+                func(conf)
+                ok = True
+            except Exception as exc:  # pylint: disable=broad-except
+                print("\n{0} failed to {1}: {2}".format(conf["id"], name, exc))
+                ok = False
+            last = not ok or idx + 1 == len(stages)
+            with cond:
+                if ok:
+                    done[name] += 1
+                else:
+                    failed.append(conf["id"])
+                self.report_progress(stages, done, failed)
+                if last:
+                    remaining[0] -= 1
+                    cond.notify_all()
+            if not last:
+                executors[idx + 1].submit(_run, idx + 1, conf)
+
+        for conf in self.confs:
+            executors[0].submit(_run, 0, conf)
+        with cond:
+            while remaining[0]:
+                cond.wait()
+        for executor in executors:
+            executor.shutdown()
+        print("")
+        if failed:
+            print("{0} minions failed to come up: {1}".format(len(failed), failed))
+
+    def report_progress(self, stages, done, failed):
+        """
+        Print how many minions made it through each stage so far
+        """
+        total = len(self.confs)
+        line = "  ".join(
+            "{0} {1}/{2}".format(name, done[name], total) for name, _, _ in stages
+        )
+        if failed:
+            line += "  failed {0}".format(len(failed))
+        sys.stdout.write("\r" + line)
+        sys.stdout.flush()
+
+    def launch(self, conf):
+        """
+        Start the salt-minion process of one minion, or hand it to a worker
+        process with --in-process
+        """
+        if self.hosts is not None:
+            self.hosts.start(conf["path"])
+            return
+        path = conf["path"]
+        cmd = "salt-minion -c {0} --pid-file {1}".format(path, "{0}.pid".format(path))
+        if self.opts["foreground"]:
+            cmd += " -l info &"
+        else:
+            cmd += " -d &"
+        with open(os.devnull, "w") as stdout:
             if self.opts["foreground"]:
-                cmd += " -l info &"
-            else:
-                cmd += " -d &"
-            with open(os.devnull, "w") as stdout:
-                if self.opts["foreground"]:
-                    stdout = sys.stdout
-                subprocess.call(cmd, shell=True, stdout=stdout)
-
-            minion = conf["id"]
-            self.wait_for([minion])
-            time.sleep(self.opts["start_delay"])
-
-            if self.opts["legion"] and self.opts["run_modules"]:
-                with open(os.devnull, "w") as stdout:
-                    subprocess.call(
-                        "salt '{}' legion.keys".format(minion),
-                        shell=True,
-                        stdout=stdout,
-                    )
-                    minions = [
-                        "{}_{}".format(minion, m) for m in range(self.opts["legion"])
-                    ]
-                    self.wait_for(minions)
-                    subprocess.call(
-                        "salt '{}' legion.cache".format(minion),
-                        shell=True,
-                        stdout=stdout,
-                    )
-                    self.wait_for([minion], attr="cached_ret")
-                    time.sleep(self.opts["legion_start_delay"])
+                stdout = sys.stdout
+            subprocess.call(cmd, shell=True, stdout=stdout)
 
-    def wait_for(self, minions, attr="accepted_minions"):
-        count = 0
-        print("Waiting for {}:".format(attr), minions, end=" ... ")
-        while 1:
-            for m in minions:
-                if m in getattr(self, attr):
-                    count += 1
-
-            if count >= len(minions):
-                print("✓")
+    def start_minion(self, conf):
+        """
+        Start one minion when the launch ramp lets it and wait for it to sign in
+        """
+        if self.opts["resume"] and self.hosts is None:
+            pid = self.minion_pid(conf)
+            if pid and conf.get("unchanged"):
+                # Still running from the run being resumed, and signed in already
                 return
+            if pid:
+                # Running with the config of the run being resumed
+                self.stop_minion(conf, pid)
+        self.launch_ramp.acquire()
+        start = time.time()
+        self.launch(conf)
+        self.wait_for([conf["id"]])
+        elapsed = time.time() - start
+        self.stats.observe("minion_start", elapsed)
+        self.startups.append((elapsed, self.minion_rss(conf)))
+        time.sleep(self.opts["start_delay"])
+
+    def stop_minion(self, conf, pid, timeout=30):
+        """
+        Stop one running minion and wait for it to exit
+        """
+        try:
+            os.kill(pid, signal.SIGTERM)
+            deadline = time.time() + timeout
+            while self.minion_pid(conf) == pid:
+                if time.time() > deadline:
+                    os.kill(pid, signal.SIGKILL)
+                    break
+                time.sleep(0.1)
+        except OSError:
+            pass
+        pidfile = "{0}.pid".format(conf["path"])
+        if os.path.exists(pidfile):
+            os.remove(pidfile)
+
+    def minion_pid(self, conf):
+        """
+        Return the pid of one running minion, or 0 if it is not running
+        """
+        try:
+            with salt.utils.files.fopen("{0}.pid".format(conf["path"])) as fp_:
+                pid = int(fp_.read().strip())
+            os.kill(pid, 0)
+        except (IOError, OSError, ValueError):
+            return 0
+        return pid
+
+    def minion_rss(self, conf):
+        """
+        Return the resident memory in bytes of one running minion
+        """
+        pid = self.minion_pid(conf)
+        return legion.proc.process_rss(pid) if pid else 0
 
-            time.sleep(2)
+    def run_keys(self, conf):
+        """
+        Have one minion sign its legion fakes in and wait for the master to see
+        all of them
+        """
+        minion = conf["id"]
+        if self.state.done(minion, "keys", self.keys_fingerprint()):
+            return
+        with open(os.devnull, "w") as stdout:
+            subprocess.call(
+                "salt '{}' legion.keys".format(minion), shell=True, stdout=stdout,
+            )
+        self.wait_for(["{}_{}".format(minion, m) for m in range(self.opts["legion"])])
+        self.state.mark(minion, "keys", self.keys_fingerprint())
 
-    def mkconf(self, idx):
+    def run_cache(self, conf):
         """
-        Create a config file for a single minion
+        Have one minion warm the caches of its legion fakes and wait for it to
+        be done
         """
+        minion = conf["id"]
+        if self.state.done(minion, "cache", conf["fingerprint"]):
+            return
+        with open(os.devnull, "w") as stdout:
+            subprocess.call(
+                "salt '{}' legion.cache".format(minion), shell=True, stdout=stdout,
+            )
+        self.wait_for([minion], attr="cached_ret")
+        self.state.mark(minion, "cache", conf["fingerprint"])
+        time.sleep(self.opts["legion_start_delay"])
+
+    def wait_for(self, minions, attr="accepted_minions"):
+        self.readiness.wait_for(minions, attr)
+
+    def probe(self):
+        """
+        Publish a job to the whole swarm without waiting for its returns, to
+        put the load of a return on every minion and fake
+        """
+        with open(os.devnull, "w") as stdout:
+            subprocess.call(
+                "salt --async '{0}-*' test.ping".format(self.opts["name"]),
+                shell=True,
+                stdout=stdout,
+            )
+
+    def keys_fingerprint(self):
+        """
+        The fingerprint the keys of a minion's fakes were registered against:
+        which master and how many fakes
+        """
+        return legion.state.fingerprint(
+            "{0}\n{1}\n{2}".format(
+                self.opts["master"], self.opts["master_pki_dir"], self.opts["legion"]
+            )
+        )
+
+    def preseed_keys(self):
+        """
+        Write the public key of every minion and legion fake straight into the
+        master's accepted keys, so none of them has to wait for its key to be
+        accepted
+        """
+        if self.opts["transport"] != "zeromq":
+            print("Keys can only be pre-seeded with the zeromq transport")
+            return
+        minions_dir = os.path.join(self.opts["master_pki_dir"], "minions")
+        if not os.path.exists(minions_dir):
+            os.makedirs(minions_dir)
+        with salt.utils.files.fopen(os.path.join(self.pki, "minion.pub")) as fp_:
+            pub = fp_.read()
+
+        print_ = self.keys_fingerprint()
+        minions = [m for m in self.minions if not self.state.done(m, "keys", print_)]
+        ids = []
+        for minion in minions:
+            ids.append(minion)
+            ids.extend("{}_{}".format(minion, m) for m in range(self.opts["legion"]))
+
+        def _write(id_):
+            with salt.utils.files.fopen(os.path.join(minions_dir, id_), "w+") as fp_:
+                fp_.write(pub)
+
+        sys.stdout.write(
+            "Pre-seeding {0} keys into {1}...".format(len(ids), minions_dir)
+        )
+        with ThreadPoolExecutor(max_workers=multiprocessing.cpu_count() * 4) as pool:
+            for _ in pool.map(_write, ids):
+                pass
+        for minion in minions:
+            self.state.mark(minion, "keys", print_)
+        print("done")
+
+    def shared_config(self):
+        """
+        Render the part of the minion config that is the same for every minion,
+        only once
+        """
+        if self._shared_config is not None:
+            return self._shared_config
         data = {}
         if self.opts["config_dir"]:
             spath = os.path.join(self.opts["config_dir"], "minion")
             with salt.utils.files.fopen(spath) as conf:
                 data = salt.utils.yaml.safe_load(conf) or {}
-        minion_id = "{0}-{1}".format(self.opts["name"], str(idx).zfill(self.zfill))
-        self.minions.append(minion_id)
-
-        dpath = os.path.join(self.swarm_root, minion_id)
-        if not os.path.exists(dpath):
-            os.makedirs(dpath)
+        for key in MINION_KEYS:
+            data.pop(key, None)
 
-        data.update(
-            {
-                "id": minion_id,
-                "user": self.opts["user"],
-                "cachedir": os.path.join(dpath, "cache"),
-                "master": self.opts["master"],
-                "log_file": os.path.join(dpath, "minion.log"),
-                "grains": {"legion": True,},
-            }
-        )
+        data.update({"user": self.opts["user"], "master": self.opts["master"]})
 
         if self.opts["legion"]:
-            data.update({"legion_fakes": self.opts["legion"], "return": "legion"})
-
-        if self.opts["transport"] == "zeromq":
-            minion_pkidir = os.path.join(dpath, "pki")
-            if not os.path.exists(minion_pkidir):
-                os.makedirs(minion_pkidir)
-                minion_pem = os.path.join(self.pki, "minion.pem")
-                minion_pub = os.path.join(self.pki, "minion.pub")
-                shutil.copy(minion_pem, minion_pkidir)
-                shutil.copy(minion_pub, minion_pkidir)
-            data["pki_dir"] = minion_pkidir
-        elif self.opts["transport"] == "tcp":
+            data.update(
+                {
+                    "legion_fakes": self.opts["legion"],
+                    "legion_return_window": self.opts["legion_window"],
+                    "legion_targeting": self.opts["legion_targeting"],
+                    "legion_stats_dir": self.stats_dir,
+                    "legion_return_model": self.opts["return_model"],
+                    "legion_return_delay": self.opts["return_delay"],
+                    "legion_return_jitter": self.opts["return_jitter"],
+                    "legion_return_sigma": self.opts["return_sigma"],
+                    "legion_return_slow_pct": self.opts["return_slow_pct"],
+                    "legion_return_slow_delay": self.opts["return_slow_delay"],
+                    "legion_return_drop_pct": self.opts["return_drop_pct"],
+                    "legion_rand_grains": [
+                        name
+                        for name in legion.grains.RAND_GRAINS
+                        if self.opts[RAND_OPTS[name]]
+                    ],
+                    "return": "legion",
+                    # Run jobs in threads of the minion, so the channel pools
+                    # of the returner outlive a job
+                    "multiprocessing": False,
+                }
+            )
+            if self.opts["legion_ramp_profile"] or self.opts["legion_ramp_rate"]:
+                ramp = {
+                    "profile": self.opts["legion_ramp_profile"],
+                    "rate": self.opts["legion_ramp_rate"],
+                    "ramp": self.opts["legion_ramp_time"],
+                    "steps": self.opts["ramp_steps"],
+                }
+                for stage in ("keys", "cache"):
+                    for key, val in six.iteritems(ramp):
+                        data["legion_{0}_{1}".format(stage, key)] = val
+
+        if self.opts["transport"] == "tcp":
             data["transport"] = "tcp"
 
         if self.opts["root_dir"]:
             data["root_dir"] = self.opts["root_dir"]
 
-        path = os.path.join(dpath, "minion")
-
         if self.opts["keep"]:
-            keep = self.opts["keep"].split(",")
+            keep = self.opts["keep"].split(",") + list(LEAN_REQUIRED)
             modpath = os.path.join(os.path.dirname(salt.__file__), "modules")
             fn_prefixes = (fn_.partition(".")[0] for fn_ in os.listdir(modpath))
             ignore = [fn_prefix for fn_prefix in fn_prefixes if fn_prefix not in keep]
             data["disable_modules"] = ignore
 
+        if self.opts["lean"]:
+            data.update(self.lean_config())
+
+        self._shared_config = salt.utils.yaml.safe_dump(data, default_flow_style=False)
+        return self._shared_config
+
+    def lean_config(self):
+        """
+        The config of the --lean profile, which cuts what every minion loads
+        and keeps in memory
+        """
+        extmods = os.path.join(self.swarm_root, "extmods")
+        if not os.path.exists(extmods):
+            os.makedirs(extmods)
+            os.chmod(extmods, 0o555)
+        if self.opts["keep"]:
+            modules = self.opts["keep"].split(",")
+            # The swarm drives its minions through these
+            modules += [mod for mod in LEAN_REQUIRED if mod not in modules]
+        else:
+            modules = list(LEAN_MODULES)
+        return {
+            "whitelist_modules": modules,
+            "disable_grains": LEAN_DISABLED_GRAINS,
+            "grains_cache": True,
+            "grains_cache_expiration": 86400,
+            "grains_refresh_every": 0,
+            "enable_gpu_grains": False,
+            "extension_modules": extmods,
+            "autoload_dynamic_modules": False,
+            "clean_dynamic_modules": False,
+            "startup_states": "",
+            "mine_enabled": False,
+            "beacons": {},
+            "multiprocessing": False,
+        }
+
+    def mkconf(self, idx):
+        """
+        Render the config of a single minion: the shared config followed by
+        the few keys that differ per minion, as JSON which is valid YAML
+        """
+        minion_id = "{0}-{1}".format(self.opts["name"], str(idx).zfill(self.zfill))
+        self.minions.append(minion_id)
+        dpath = os.path.join(self.swarm_root, minion_id)
+
+        data = {
+            "id": minion_id,
+            "cachedir": os.path.join(dpath, "cache"),
+            "log_file": os.path.join(dpath, "minion.log"),
+            "grains": {"legion": True},
+        }
+        if self.opts["transport"] == "zeromq":
+            if self.opts["in_process"]:
+                # Minions hosted in one process share their loaded keys
+                data["pki_dir"] = self.pki
+            else:
+                data["pki_dir"] = os.path.join(dpath, "pki")
+
         if self.opts["rand_os"]:
-            data["grains"]["os"] = random.choice(OSES)
+            data["grains"]["os"] = random.choice(legion.grains.OSES)
         if self.opts["rand_ver"]:
-            data["grains"]["saltversion"] = random.choice(VERS)
+            data["grains"]["saltversion"] = random.choice(legion.grains.VERS)
         if self.opts["rand_machine_id"]:
-            data["grains"]["machine_id"] = hashlib.md5(minion_id).hexdigest()
+            data["grains"]["machine_id"] = hashlib.md5(
+                minion_id.encode("utf-8")
+            ).hexdigest()
         if self.opts["rand_uuid"]:
-            data["grains"]["uuid"] = str(uuid.uuid4())
+            # Drawn from the seeded generator, so a resumed swarm renders the
+            # same configs
+            data["grains"]["uuid"] = str(
+                uuid.UUID(int=random.getrandbits(128), version=4)
+            )
+
+        text = self.shared_config() + "".join(
+            "{0}: {1}\n".format(key, json.dumps(val))
+            for key, val in sorted(data.items())
+        )
+        self.confs.append(
+            {
+                "path": dpath,
+                "id": minion_id,
+                "text": text,
+                "fingerprint": legion.state.fingerprint(text),
+            }
+        )
+
+    def write_conf(self, conf):
+        """
+        Write the config and keys of a single minion to its directory
+        """
+        dpath = conf["path"]
+        path = os.path.join(dpath, "minion")
+        text = conf.pop("text")
+        done = self.state.done(conf["id"], "config", conf["fingerprint"])
+        # Whether a minion still running from the run being resumed has the
+        # config it would be started with now
+        conf["unchanged"] = done and os.path.exists(path)
+        if conf["unchanged"]:
+            return
+        if not os.path.exists(dpath):
+            os.makedirs(dpath)
+
+        if self.opts["transport"] == "zeromq" and not self.opts["in_process"]:
+            minion_pkidir = os.path.join(dpath, "pki")
+            if not os.path.exists(minion_pkidir):
+                os.makedirs(minion_pkidir)
+                for name in ("minion.pem", "minion.pub"):
+                    src = os.path.join(self.pki, name)
+                    try:
+                        os.link(src, os.path.join(minion_pkidir, name))
+                    except OSError:
+                        shutil.copy(src, minion_pkidir)
 
         with salt.utils.files.fopen(path, "w+") as fp_:
-            salt.utils.yaml.safe_dump(data, fp_)
-        self.confs.append({"path": dpath, "id": minion_id})
+            fp_.write(text)
+        self.state.mark(conf["id"], "config", conf["fingerprint"])
 
     def prep_configs(self):
         """
@@ -511,6 +1332,9 @@ class MinionSwarm(Swarm):
         """
         for idx in range(self.opts["minions"]):
             self.mkconf(idx)
+        with ThreadPoolExecutor(max_workers=multiprocessing.cpu_count() * 4) as pool:
+            for _ in pool.map(self.write_conf, self.confs):
+                pass
 
 
 class MasterSwarm(Swarm):
@@ -519,8 +1343,9 @@ class MasterSwarm(Swarm):
     """
 
     def __init__(self, opts):
-        super(MasterSwarm, self).__init__(opts)
+        super(MasterSwarm, self).__init__(opts, None)
         self.conf = os.path.join(self.swarm_root, "master")
+        self.pki_dir = os.path.join(self.conf, "pki")
 
     def start(self):
         """
@@ -557,14 +1382,14 @@ class MasterSwarm(Swarm):
             spath = os.path.join(self.opts["config_dir"], "master")
             with salt.utils.files.fopen(spath) as conf:
                 data = salt.utils.yaml.safe_load(conf)
-        data.update(
-            {
-                "log_file": os.path.join(self.conf, "master.log"),
-                "open_mode": True,  # TODO Pre-seed keys
-            }
-        )
+        data.update({"log_file": os.path.join(self.conf, "master.log")})
+        if self.opts["preseed_keys"]:
+            data["pki_dir"] = self.pki_dir
+        else:
+            data["open_mode"] = True
 
-        os.makedirs(self.conf)
+        if not os.path.exists(self.conf):
+            os.makedirs(self.conf)
         path = os.path.join(self.conf, "master")
 
         with salt.utils.files.fopen(path, "w+") as fp_:
@@ -580,19 +1405,29 @@ class MasterSwarm(Swarm):
 
 
 def main():
-    with multiprocessing.Manager() as manager:
-        accepted_minions = manager.dict()
-        cached = manager.dict()
-        event_busser = multiprocessing.Process(
-            target=event_listener, args=(accepted_minions, cached), daemon=True
-        )
-        event_busser.start()
+    if sys.argv[1:2] == ["bench"]:
+        legion.bench.main(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ["microbench"]:
+        legion.microbench.main(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ["sweep"]:
+        legion.sweep.main(sys.argv[2:])
+        return
+    opts = parse()
+    readiness = legion.readiness.Readiness(
+        opts["name"], opts["minions"], opts["legion"]
+    )
+    event_busser = multiprocessing.Process(
+        target=event_listener, args=(readiness,), daemon=True
+    )
+    event_busser.start()
 
-        swarm = Swarm(parse(), accepted_minions, cached)
-        try:
-            swarm.start()
-        finally:
-            swarm.shutdown()
+    swarm = Swarm(opts, readiness)
+    try:
+        swarm.start()
+    finally:
+        swarm.shutdown()
 
 
 # pylint: disable=C0103
@@ -15,3 +15,10 @@ def module_dirs():
     yield one path per parent directory of where execution modules can be found
     """
     yield os.path.join(PKG_DIR, "modules")
+
+
+def matcher_dirs():
+    """
+    yield one path per parent directory of where matcher modules can be found
+    """
+    yield os.path.join(PKG_DIR, "matchers")
@@ -0,0 +1,12 @@
+# Import legion libs
+import legion.targeting
+
+
+def match(tgt, opts=None):
+    """
+    Match the minion, or with ``legion_targeting`` on any of its fakes, with
+    salt's compound matcher
+    """
+    if opts is not None:
+        return legion.targeting.match(opts, tgt, "compound")
+    return legion.targeting.match_any(__opts__, tgt, "compound")
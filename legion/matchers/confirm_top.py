@@ -0,0 +1,34 @@
+"""
+Match top file entries against the minion alone, the fakes do not run states
+"""
+# Import python libs
+import logging
+
+# Import salt libs
+import salt.loader
+
+log = logging.getLogger(__name__)
+
+
+def confirm_top(match, data, nodegroups=None):
+    """
+    Takes the data passed to a top file environment and determines if the
+    data matches this minion. ``legion_targeting`` only widens the check of
+    what the minion was published to, so states that target a fake are not
+    applied to the minion.
+    """
+    matcher = "compound"
+    if not data:
+        log.error("Received bad data when setting the match from the top file")
+        return False
+    for item in data:
+        if isinstance(item, dict) and "match" in item:
+            matcher = item["match"]
+
+    opts = dict(__opts__)
+    opts["legion_targeting"] = False
+    matchers = salt.loader.matchers(opts)
+    funcname = matcher + "_match.match"
+    if matcher == "nodegroup":
+        return matchers[funcname](match, nodegroups)
+    return matchers[funcname](match)
@@ -0,0 +1,15 @@
+# Import salt libs
+from salt.defaults import DEFAULT_TARGET_DELIM
+
+# Import legion libs
+import legion.targeting
+
+
+def match(tgt, delimiter=DEFAULT_TARGET_DELIM, opts=None):
+    """
+    Match the minion, or with ``legion_targeting`` on any of its fakes, with
+    salt's grain_pcre matcher
+    """
+    if opts is not None:
+        return legion.targeting.match(opts, tgt, "grain_pcre", delimiter=delimiter)
+    return legion.targeting.match_any(__opts__, tgt, "grain_pcre", delimiter=delimiter)
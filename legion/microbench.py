@@ -0,0 +1,216 @@
+"""
+Measure the throughput of legion's hot paths, the fakes signing in and the
+fakes returning, against a stub master for a range of fake counts. Requests
+take the same channels, serialization, AES and ZeroMQ transport they take to
+a real master, only the master's side is stubbed.
+"""
+# Import python libs
+from __future__ import absolute_import, print_function
+import os
+import json
+import time
+import shutil
+import optparse
+import platform
+import tempfile
+
+# Import salt libs
+import salt.log  # pylint: disable=unused-import
+import salt.config
+import salt.crypt
+import salt.utils.files
+import salt.version
+
+# Import legion libs
+import legion.channel
+import legion.modules.legion
+import legion.returners.legion
+import legion.stubmaster
+
+
+def make_pki(path):
+    """
+    Generate the minion keys, and the master's public key as the minion
+    caches it, into ``path``
+    """
+    salt.crypt.gen_keys(path, "minion", 2048)
+    salt.crypt.gen_keys(path, "master", 2048)
+    shutil.copy(
+        os.path.join(path, "master.pub"), os.path.join(path, "minion_master.pub")
+    )
+
+
+def measure(func, count):
+    """
+    Run ``func`` and return how many of ``count`` operations it did a second
+    and the CPU time it took per operation
+    """
+    wall, cpu = time.time(), time.process_time()
+    func()
+    wall, cpu = time.time() - wall, time.process_time() - cpu
+    return count / wall if wall else 0.0, cpu / count
+
+
+def run(opts):
+    """
+    Sign in and return for every fake count, and return the results
+    """
+    pki_dir = tempfile.mkdtemp(prefix="legion-microbench")
+    results = []
+    try:
+        make_pki(pki_dir)
+        master = legion.stubmaster.StubMaster(
+            pki_dir, opts["latency"], opts["jitter"], seed=0
+        )
+        with master:
+            for count in opts["counts"]:
+                results.append(run_count(opts, master, pki_dir, count))
+                print(
+                    "{fakes} fakes: {auths_per_sec:.0f} auths/s "
+                    "({auth_cpu_per_fake:.6f}s CPU, {auth_bytes_per_fake:.0f} "
+                    "bytes per fake), {returns_per_sec:.0f} returns/s "
+                    "({return_cpu_per_fake:.6f}s CPU, {return_bytes_per_fake:.0f} "
+                    "bytes per fake)".format(**results[-1])
+                )
+            legion.channel.close_pools()
+    finally:
+        shutil.rmtree(pki_dir, ignore_errors=True)
+    return {
+        "python": platform.python_version(),
+        "salt": salt.version.__version__,
+        "options": dict(
+            (key, opts[key])
+            for key in (
+                "latency",
+                "jitter",
+                "concurrency",
+                "window",
+                "token_pool",
+                "sign",
+            )
+        ),
+        "results": results,
+    }
+
+
+def run_count(opts, master, pki_dir, count):
+    """
+    Sign ``count`` fakes in and have them all return one job
+    """
+    mopts = salt.config.minion_config(None)
+    mopts.update(
+        {
+            "id": "microbench",
+            "pki_dir": pki_dir,
+            "cachedir": pki_dir,
+            "sock_dir": pki_dir,
+            "transport": "zeromq",
+            "master_ip": "127.0.0.1",
+            "master_port": master.port.value,
+            "master_uri": master.uri,
+            "legion_fakes": count,
+            "legion_return_window": opts["window"],
+            "legion_keys_token_pool": opts["token_pool"],
+            "legion_channel_pool_size": max(opts["window"], opts["concurrency"]),
+            "minion_sign_messages": opts["sign"],
+        }
+    )
+    for mod in (legion.modules.legion, legion.returners.legion):
+        mod.__opts__ = mopts
+        mod.__grains__ = {"id": mopts["id"], "os": "Linux"}
+    ret = {"fakes": count}
+
+    master.reset()
+    ret["auths_per_sec"], ret["auth_cpu_per_fake"] = measure(
+        lambda: legion.modules.legion.keys(concurrency=opts["concurrency"]), count
+    )
+    ret["auth_bytes_per_fake"] = master.bytes["_auth"] / float(count)
+
+    master.reset()
+    job = {
+        "jid": "20261018000000000000",
+        "fun": "test.ping",
+        "fun_args": [],
+        "return": True,
+        "retcode": 0,
+        "success": True,
+    }
+    ret["returns_per_sec"], ret["return_cpu_per_fake"] = measure(
+        lambda: legion.returners.legion.returner(job), count
+    )
+    ret["return_bytes_per_fake"] = master.bytes["_return"] / float(count)
+    return ret
+
+
+def parse(args):
+    """
+    Parse the cli options of ``legion microbench``
+    """
+    parser = optparse.OptionParser(usage="%prog microbench [options]")
+    parser.add_option(
+        "--counts",
+        dest="counts",
+        default="10,100,1000,10000,100000",
+        help="A comma delimited list of the fake counts to measure",
+    )
+    parser.add_option(
+        "--latency",
+        dest="latency",
+        default=0.0,
+        type="float",
+        help="Seconds the stub master takes to answer a request",
+    )
+    parser.add_option(
+        "--jitter",
+        dest="jitter",
+        default=0.0,
+        type="float",
+        help="Seconds the latency of the stub master varies by, either way",
+    )
+    parser.add_option(
+        "--concurrency",
+        dest="concurrency",
+        default=10,
+        type="int",
+        help="The number of fakes signing in at once",
+    )
+    parser.add_option(
+        "--window",
+        dest="window",
+        default=10,
+        type="int",
+        help="The number of fake returns in flight at once",
+    )
+    parser.add_option(
+        "--token-pool",
+        dest="token_pool",
+        default=0,
+        type="int",
+        help="The number of sign in tokens to encrypt up front",
+    )
+    parser.add_option(
+        "--sign",
+        dest="sign",
+        default=False,
+        action="store_true",
+        help="Sign the returns, as with minion_sign_messages",
+    )
+    parser.add_option(
+        "-o",
+        "--output",
+        dest="output",
+        default="legion-microbench.json",
+        help="The JSON file the results are written to",
+    )
+    options, _args = parser.parse_args(args)
+    opts = dict(options.__dict__)
+    opts["counts"] = [int(count) for count in opts["counts"].split(",")]
+    return opts
+
+
+def main(args):
+    opts = parse(args)
+    report = run(opts)
+    with salt.utils.files.fopen(opts["output"], "w") as fp_:
+        json.dump(report, fp_, indent=2, sort_keys=True)
+    print("Results written to {0}".format(opts["output"]))
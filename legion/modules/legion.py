@@ -1,103 +1,281 @@
 # Import python libs
-import os
 import copy
+import json
+import time
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
 
 # Import salt libs
 import salt.pillar
-import salt.transport.client
-import salt.crypt
-import salt.utils.crypt
 import salt.utils.stringutils
-from salt.exceptions import (
-    AuthenticationError,
-    SaltClientError,
-    SaltReqTimeoutError,
-    MasterExit,
-)
-
-# Import third party libs
-try:
-    from M2Crypto import RSA
-
-    HAS_M2 = True
-except ImportError:
-    HAS_M2 = False
-
-if not HAS_M2:
-    try:
-        from Cryptodome.Cipher import PKCS1_OAEP
-
-        HAS_CDOME = True
-    except ImportError:
-        HAS_CDOME = False
-
-if not HAS_M2 and not HAS_CDOME:
-    try:
-        from Crypto.Cipher import PKCS1_OAEP
-    except ImportError:
-        # No need for crypt in local mode
-        pass
-
-
-def _minion_sign_in_payload(id_):
-    """
-    Generates the payload used to authenticate with the master
-    server. This payload consists of the passed in id_ and the ssh
-    public key to encrypt the AES key sent back from the master.
-    :return: Payload dictionary
-    :rtype: dict
-    """
-    payload = {}
-    payload["cmd"] = "_auth"
-    payload["id"] = id_
-    mpub = "minion_master.pub"
-    token = salt.utils.stringutils.to_bytes(salt.crypt.Crypticle.generate_key_string())
-    pub_path = os.path.join(__opts__["pki_dir"], "minion.pub")
-    try:
-        pubkey_path = os.path.join(__opts__["pki_dir"], mpub)
-        pub = salt.crypt.get_rsa_pub_key(pubkey_path)
-        if HAS_M2:
-            payload["token"] = pub.public_encrypt(token, RSA.pkcs1_oaep_padding)
-        else:
-            cipher = PKCS1_OAEP.new(pub)
-            payload["token"] = cipher.encrypt(token)
-    except Exception:
-        pass
-    with salt.utils.files.fopen(pub_path) as f:
-        payload["pub"] = f.read()
-    return payload
-
-
-def keys():
+from salt.exceptions import SaltClientError, SaltReqTimeoutError
+
+# Import legion libs
+import legion.channel
+import legion.crypt
+import legion.fakes
+import legion.pacing
+import legion.stats
+
+log = logging.getLogger(__name__)
+
+
+def _option(val, name, default):
+    """
+    Fall back to the ``name`` minion config option for an argument not passed
+    """
+    if val is None:
+        val = __opts__.get(name, default)
+    return val
+
+
+def _key_state(payload):
+    """
+    Tell from the master's reply to a sign in whether the fake's key is
+    accepted, pending, rejected or whether the sign in should be retried
+    """
+    if not isinstance(payload, dict):
+        return "retry"
+    if "aes" in payload:
+        return "accepted"
+    ret = payload.get("load", {}).get("ret")
+    if ret is False:
+        return "rejected"
+    if ret == "full":
+        return "retry"
+    return "pending"
+
+
+def _sign_in(pool, payloads, bucket, id_, retries, backoff, timeout):
+    """
+    Sign a fake in with the master, backing off exponentially between retries
+    """
+    stats = legion.stats.get(__opts__)
+    for attempt in range(retries + 1):
+        if attempt:
+            stats.incr("keys_retries")
+            time.sleep(backoff * 2 ** (attempt - 1))
+        bucket.acquire()
+        try:
+            with pool.channel() as channel:
+                with stats.timer("keys_auth"):
+                    payload = channel.send(payloads(id_), tries=1, timeout=timeout)
+        except (SaltClientError, SaltReqTimeoutError) as exc:
+            log.debug("Sign in of %s failed: %s", id_, exc)
+            continue
+        state = _key_state(payload)
+        if state != "retry":
+            return state
+    return "failed"
+
+
+def _pacer(stage, rate, burst, profile):
+    """
+    Build the pacer of the ``keys`` or ``cache`` stage from its
+    ``legion_<stage>_*`` minion config options
+    """
+    return legion.pacing.pacer(
+        _option(profile, "legion_{}_profile".format(stage), None),
+        float(_option(rate, "legion_{}_rate".format(stage), 0)),
+        burst,
+        float(__opts__.get("legion_{}_ramp".format(stage), 0)),
+        int(__opts__.get("legion_{}_steps".format(stage), 4)),
+    )
+
+
+def keys(
+    concurrency=None, rate=None, burst=None, retries=None, backoff=None, profile=None
+):
     """
     Send the salt master a collection of fake keys, these are use to populate the master's key
     cache to facilitiate emulating many minions inside of this single minion
+
+    Up to ``concurrency`` fakes sign in at once, at no more than ``rate`` sign
+    ins a second (0 for no limit) in bursts of up to ``burst``. A fake whose
+    sign in times out is retried up to ``retries`` times, waiting ``backoff``
+    seconds and doubling that wait after every failure. Each argument defaults
+    to the matching ``legion_keys_*`` minion config option.
+
+    The key material is loaded once for the whole run. With
+    ``legion_keys_token_pool`` set, that many sign in tokens are encrypted up
+    front and shared by the fakes instead of one being encrypted per fake.
+
+    All ``legion_fakes`` fakes sign in, including those the ``legion_active``
+    file in the cachedir keeps from returning, so they can be switched on
+    later.
+
+    Returns the ids of the fakes whose keys the master accepted, holds as
+    pending and those which could not be signed in.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' legion.keys concurrency=20 rate=50
+    """
+    concurrency = max(1, int(_option(concurrency, "legion_keys_concurrency", 10)))
+    bucket = _pacer(
+        "keys", rate, int(_option(burst, "legion_keys_burst", concurrency)), profile
+    )
+    retries = int(_option(retries, "legion_keys_retries", 3))
+    backoff = float(_option(backoff, "legion_keys_backoff", 1.0))
+    timeout = __opts__.get("legion_keys_timeout", 30)
+    pool = legion.channel.get_pool(__opts__, crypt="clear")
+    pool.reserve(concurrency)
+    payloads = legion.crypt.SignInPayloads(
+        __opts__, __opts__.get("legion_keys_token_pool", 0)
+    )
+    ids = legion.fakes.fake_ids(__opts__, active=False)
+
+    def _register(id_):
+        return _sign_in(pool, payloads, bucket, id_, retries, backoff, timeout)
+
+    ret = {"accepted": [], "pending": [], "failed": []}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for id_, state in zip(ids, executor.map(_register, ids)):
+            if state not in ret:
+                state = "failed"
+            ret[state].append(id_)
+    stats = legion.stats.get(__opts__)
+    for state, fakes in ret.items():
+        stats.incr("keys_{}".format(state), len(fakes))
+    stats.flush()
+    return ret
+
+
+def _pillar_load(id_):
+    """
+    Generates the load a remote minion sends to have the master compile its pillar
+    """
+    return {
+        "cmd": "_pillar",
+        "id": id_,
+        "grains": legion.fakes.grains(__opts__, __grains__, id_),
+        "saltenv": __opts__.get("saltenv"),
+        "pillarenv": __opts__.get("pillarenv"),
+        "pillar_override": {},
+        "extra_minion_data": {},
+        "ver": "2",
+    }
+
+
+def _compile_pillar(pool, id_):
+    """
+    Have the pillar of the fake ``id_`` compiled, by the master unless the
+    minion is masterless
     """
-    channel = salt.transport.client.ReqChannel.factory(__opts__, crypt="clear")
+    if pool is not None:
+        with pool.channel() as channel:
+            return channel.crypted_transfer_decode_dictentry(
+                _pillar_load(id_), dictkey="pillar"
+            )
+    opts = copy.deepcopy(__opts__)
+    opts["id"] = id_
+    pillar = salt.pillar.get_pillar(
+        opts,
+        legion.fakes.grains(__opts__, __grains__, id_),
+        id_,
+        pillar_override=None,
+        pillarenv=None,
+    )
+    return pillar.compile_pillar()
 
-    try:
-        for ind in range(__opts__.get("legion_fakes", 10)):
-            id_ = "{}_{}".format(__opts__["id"], ind)
-            sign_in_payload = _minion_sign_in_payload(id_)
-            payload = channel.send(sign_in_payload, tries=0, timeout=30,)
-    except SaltReqTimeoutError as e:
-        raise SaltClientError(
-            "Attempt to authenticate with the salt master failed with timeout error"
-        )
-    finally:
-        channel.close()
+
+def _digest(pillar):
+    """
+    Fingerprint a compiled pillar so identical ones can be told apart cheaply
+    """
+    data = json.dumps(pillar, sort_keys=True, default=str)
+    return hashlib.sha256(salt.utils.stringutils.to_bytes(data)).hexdigest()
 
 
-def cache():
+def cache(concurrency=None, dedupe=None, probe=None, rate=None, profile=None):
     """
     Populate the master with the fake minions' grains and pillars by requesting pillars on behalf
     of the fakes
+
+    Every fake sends the minion's grains with its own id and the grains named
+    in ``legion_rand_grains`` (os, saltversion, machine_id and uuid) picked
+    from its id. Like ``legion.keys`` this covers every fake, active or not.
+
+    Up to ``concurrency`` pillars are compiled at once, started at no more
+    than ``rate`` a second (0 for no limit) or following the ramp ``profile``
+    the way ``legion.keys`` does. With ``dedupe`` on a masterless minion
+    (``file_client: local``) the pillars of the first ``probe`` fakes are
+    compiled first, and when they are all identical the remaining fakes share
+    that result instead of having their own compiled. With a master every
+    fake's request is what puts its grains and pillar in the master's cache,
+    so ``dedupe`` is turned off.
+    Each argument defaults to the matching ``legion_cache_*`` minion config
+    option.
+
+    Returns how long the pillar of every fake took to compile, and how many
+    pillars were compiled, shared, distinct and failed.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' legion.cache concurrency=5
+        salt '*' legion.cache dedupe=True probe=3
     """
-    for ind in range(__opts__.get("legion_fakes", 10)):
-        id_ = "{}_{}".format(__opts__["id"], ind)
-        opts = copy.deepcopy(__opts__)
-        opts["id"] = id_
-        pillar = salt.pillar.get_pillar(
-            __opts__, __grains__, id_, pillar_override=None, pillarenv=None
-        )
-        pillar.compile_pillar()
+    concurrency = max(1, int(_option(concurrency, "legion_cache_concurrency", 1)))
+    dedupe = _option(dedupe, "legion_cache_dedupe", False)
+    probe = max(2, int(_option(probe, "legion_cache_probe", 2)))
+    bucket = _pacer("cache", rate, concurrency, profile)
+    pool = None
+    if __opts__.get("file_client", "remote") == "remote":
+        pool = legion.channel.get_pool(__opts__)
+        pool.reserve(concurrency)
+        if dedupe:
+            log.warning(
+                "Not deduping pillars, the master caches the grains and "
+                "pillar of every fake it compiles one for"
+            )
+            dedupe = False
+    ids = legion.fakes.fake_ids(__opts__, active=False)
+    stats = legion.stats.get(__opts__)
+    ret = {"fakes": {}, "compiled": 0, "shared": 0, "failed": []}
+    digests = set()
+
+    def _warm(id_):
+        bucket.acquire()
+        start = time.time()
+        try:
+            pillar = _compile_pillar(pool, id_)
+        except Exception as exc:  # pylint: disable=broad-except
+            log.error("Failed to compile the pillar of %s: %s", id_, exc)
+            return id_, None, time.time() - start
+        stats.observe("cache_compile", time.time() - start)
+        return id_, _digest(pillar), time.time() - start
+
+    def _run(batch):
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for id_, digest, elapsed in executor.map(_warm, batch):
+                ret["fakes"][id_] = {"time": elapsed, "shared": False}
+                if digest is None:
+                    ret["failed"].append(id_)
+                    continue
+                ret["compiled"] += 1
+                digests.add(digest)
+
+    start = time.time()
+    rest = ids
+    if dedupe and len(ids) > probe:
+        _run(ids[:probe])
+        rest = ids[probe:]
+        if len(digests) == 1 and not ret["failed"]:
+            log.info("The pillar does not depend on the minion id, sharing it")
+            for id_ in rest:
+                ret["fakes"][id_] = {"time": 0.0, "shared": True}
+            ret["shared"] = len(rest)
+            rest = []
+    _run(rest)
+    ret["distinct"] = len(digests)
+    ret["time"] = time.time() - start
+    stats.incr("cache_compiled", ret["compiled"])
+    stats.incr("cache_shared", ret["shared"])
+    stats.incr("cache_failed", len(ret["failed"]))
+    stats.flush()
+    return ret
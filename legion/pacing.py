@@ -0,0 +1,140 @@
+"""
+Pace the requests legion makes of the master, so bringing fakes up does not
+turn into a thundering herd
+"""
+# Import python libs
+import math
+import time
+import random
+import threading
+
+PROFILES = ("constant", "linear", "stepped", "exponential", "poisson")
+
+
+class TokenBucket(object):
+    """
+    Hand out at most ``rate`` tokens a second, in bursts of up to ``burst``
+    tokens. A rate of 0 hands them out without limit.
+    """
+
+    def __init__(self, rate=0, burst=1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a token is available and take it
+        """
+        if not self.rate:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.stamp) * self.rate
+                )
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class Ramp(object):
+    """
+    Space arrivals out so they follow a load shape that reaches ``rate``
+    arrivals a second after ``ramp`` seconds and holds it from then on:
+
+    constant
+        ``rate`` arrivals a second from the start
+    linear
+        the rate climbs steadily from 0 to ``rate``
+    stepped
+        the rate climbs to ``rate`` in ``steps`` equal steps
+    exponential
+        the rate doubles ``steps`` times, from ``rate / 2 ** steps`` up to
+        ``rate``
+    poisson
+        arrivals at random with ``rate`` arrivals a second on average
+
+    A rate of 0 lets every arrival through at once.
+    """
+
+    def __init__(self, profile="constant", rate=0, ramp=0, steps=4, seed=None):
+        if profile not in PROFILES:
+            raise ValueError(
+                "Unknown ramp profile {0}, pick one of {1}".format(
+                    profile, ", ".join(PROFILES)
+                )
+            )
+        self.profile = profile
+        self.rate = float(rate)
+        self.ramp = float(ramp) if profile not in ("constant", "poisson") else 0.0
+        self.steps = max(1, int(steps))
+        self._rand = random.Random(seed)
+        self._lock = threading.Lock()
+        self._start = None
+        self._count = 0
+        self._last = 0.0
+
+    def arrival(self, count):
+        """
+        Return how many seconds after the first arrival the ``count``th one is
+        due. Poisson arrivals are drawn one after the other, so ask for them in
+        order.
+        """
+        rate, ramp = self.rate, self.ramp
+        if self.profile == "poisson":
+            if count:
+                self._last += self._rand.expovariate(rate)
+            return self._last
+        if self.profile == "linear" and ramp:
+            ramped = rate * ramp / 2
+            if count < ramped:
+                return math.sqrt(2 * ramp * count / rate)
+            return ramp + (count - ramped) / rate
+        if self.profile == "stepped" and ramp:
+            span = ramp / self.steps
+            for step in range(self.steps):
+                step_rate = rate * (step + 1) / self.steps
+                if count < step_rate * span:
+                    return step * span + count / step_rate
+                count -= step_rate * span
+            return ramp + count / rate
+        if self.profile == "exponential" and ramp:
+            growth = self.steps * math.log(2) / ramp
+            floor = math.exp(-growth * ramp)
+            ramped = rate / growth * (1 - floor)
+            if count < ramped:
+                return ramp + math.log(count * growth / rate + floor) / growth
+            return ramp + (count - ramped) / rate
+        return count / rate
+
+    def acquire(self):
+        """
+        Block until the next arrival is due
+        """
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if self._start is None:
+                self._start = now
+            due = self._start + self.arrival(self._count)
+            self._count += 1
+        if due > now:
+            time.sleep(due - now)
+
+
+def pacer(profile=None, rate=0, burst=1, ramp=0, steps=4, seed=None):
+    """
+    Return a token bucket when no ramp ``profile`` is given, a ramp following
+    that profile otherwise. Both hand out arrivals through ``acquire``.
+    """
+    if not profile:
+        return TokenBucket(rate, burst)
+    return Ramp(profile, rate, ramp, steps, seed)
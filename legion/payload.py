@@ -0,0 +1,72 @@
+"""
+Helpers to work on loads that are already msgpack serialized, so a load is
+serialized once and the same bytes are signed and sent
+"""
+# Import python libs
+import struct
+
+# Import salt libs
+import salt.serializers.msgpack
+
+
+def serialize(load):
+    """
+    Serialize a load the way the master does when it verifies a signature
+    """
+    return salt.serializers.msgpack.serialize(load)
+
+
+def split_map(payload):
+    """
+    Split a serialized map into its number of items and the serialized items,
+    the latter as a view on ``payload`` rather than a copy of it
+    """
+    payload = memoryview(payload)
+    first = payload[0]
+    if 0x80 <= first <= 0x8F:
+        return first & 0x0F, payload[1:]
+    if first == 0xDE:
+        return struct.unpack(">H", payload[1:3])[0], payload[3:]
+    if first == 0xDF:
+        return struct.unpack(">I", payload[1:5])[0], payload[5:]
+    raise ValueError("Payload is not a serialized map")
+
+
+def map_header(count):
+    """
+    Serialize the header of a map holding ``count`` items
+    """
+    if count < 16:
+        return struct.pack(">B", 0x80 | count)
+    if count < 0x10000:
+        return struct.pack(">BH", 0xDE, count)
+    return struct.pack(">BI", 0xDF, count)
+
+
+def extend(payload, items):
+    """
+    Add the ``items`` dict to the end of a serialized map without serializing
+    the map again
+    """
+    count, body = split_map(payload)
+    extra_count, extra = split_map(serialize(items))
+    return b"".join((map_header(count + extra_count), body, extra))
+
+
+class Template(object):
+    """
+    A serialized map of the items shared by many loads.
+
+    The shared items are serialized once, rendering a load only serializes the
+    items that differ and splices them in front of the shared ones.
+    """
+
+    def __init__(self, shared):
+        self.count, self.body = split_map(serialize(shared))
+
+    def render(self, items):
+        """
+        Serialize the load made of ``items`` followed by the shared items
+        """
+        count, head = split_map(serialize(items))
+        return b"".join((map_header(self.count + count), head, self.body))
@@ -0,0 +1,51 @@
+"""
+Read what the processes of the swarm use from /proc
+"""
+# Import python libs
+import os
+
+
+def process_tree(pid):
+    """
+    Return the pid of a process followed by the pids of its children
+    """
+    pids = [pid]
+    try:
+        with open("/proc/{0}/task/{0}/children".format(pid)) as fp_:
+            pids.extend(int(child) for child in fp_.read().split())
+    except (IOError, OSError):
+        pass
+    return pids
+
+
+def process_rss(pid):
+    """
+    Return the resident memory in bytes of a process and its children
+    """
+    rss = 0
+    for pid_ in process_tree(pid):
+        try:
+            with open("/proc/{0}/status".format(pid_)) as fp_:
+                for line in fp_:
+                    if line.startswith("VmRSS:"):
+                        rss += int(line.split()[1]) * 1024
+                        break
+        except (IOError, OSError):
+            pass
+    return rss
+
+
+def process_cpu(pid):
+    """
+    Return the CPU seconds a process and its children used so far
+    """
+    ticks = 0
+    for pid_ in process_tree(pid):
+        try:
+            with open("/proc/{0}/stat".format(pid_)) as fp_:
+                # The command name can hold spaces, the fields follow its ")"
+                fields = fp_.read().rpartition(")")[2].split()
+            ticks += int(fields[11]) + int(fields[12])
+        except (IOError, OSError, IndexError, ValueError):
+            pass
+    return ticks / float(os.sysconf("SC_CLK_TCK"))
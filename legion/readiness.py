@@ -0,0 +1,111 @@
+"""
+Track which minions and fakes of the swarm the master has seen, in bitmaps
+shared between the event listener and the swarm, so neither the lookups nor
+the waits grow with the size of the swarm
+"""
+# Import python libs
+import time
+import ctypes
+import multiprocessing
+
+ATTRS = ("accepted_minions", "cached_ret")
+
+
+class Layout(object):
+    """
+    Where every id of a swarm goes in a bitmap.
+
+    The ids of a swarm are ``<name>-<minion index>`` for its minions and
+    ``<name>-<minion index>_<fake index>`` for their fakes, so an id maps to
+    its slot ``minion index * (fakes + 1) + fake index + 1`` (``+ 0`` for the
+    minion itself) without a lookup table. Ids that are not part of the swarm
+    have no slot.
+    """
+
+    def __init__(self, name, minions, fakes):
+        self.prefix = "{0}-".format(name)
+        self.minions = minions
+        self.fakes = fakes
+        self.size = minions * (fakes + 1)
+
+    def slot(self, id_):
+        """
+        Return the slot of ``id_``, or None if it is not part of the swarm
+        """
+        if not id_.startswith(self.prefix):
+            return None
+        minion, _, fake = id_[len(self.prefix) :].partition("_")
+        try:
+            minion = int(minion)
+            fake = int(fake) + 1 if fake else 0
+        except ValueError:
+            return None
+        if not 0 <= minion < self.minions or not 0 <= fake <= self.fakes:
+            return None
+        return minion * (self.fakes + 1) + fake
+
+
+class Readiness(Layout):
+    """
+    One bit per id of the swarm for every ``ATTRS`` state, in shared memory.
+    Ids that are not part of the swarm are ignored.
+
+    The event listener process sets the bits, the swarm waits on them.
+    """
+
+    def __init__(self, name, minions, fakes):
+        super(Readiness, self).__init__(name, minions, fakes)
+        self.bits = dict(
+            (attr, multiprocessing.RawArray(ctypes.c_ubyte, self.size // 8 + 1))
+            for attr in ATTRS
+        )
+        self.counts = dict(
+            (attr, multiprocessing.RawValue(ctypes.c_long, 0)) for attr in ATTRS
+        )
+        self._cond = multiprocessing.Condition()
+
+    def _is_set(self, attr, slot):
+        return self.bits[attr][slot >> 3] & (1 << (slot & 7))
+
+    def mark(self, attr, id_):
+        """
+        Record that ``id_`` reached ``attr`` and wake the waiters. Only the
+        event listener calls this, so the bitmaps have a single writer.
+        """
+        slot = self.slot(id_)
+        if slot is None or self._is_set(attr, slot):
+            return
+        with self._cond:
+            self.bits[attr][slot >> 3] |= 1 << (slot & 7)
+            self.counts[attr].value += 1
+            self._cond.notify_all()
+
+    def ready(self, attr="accepted_minions"):
+        """
+        Return how many ids reached ``attr``
+        """
+        return self.counts[attr].value
+
+    def wait_for(self, ids, attr="accepted_minions", count=None, timeout=None):
+        """
+        Block until ``count`` (all by default) of ``ids`` reached ``attr``.
+        Every wake up only looks at the ids still missing. Returns whether
+        they made it before the ``timeout``.
+        """
+        missing = []
+        for id_ in ids:
+            slot = self.slot(id_)
+            if slot is None:
+                raise ValueError("{0} is not part of the swarm".format(id_))
+            missing.append(slot)
+        allowed = 0 if count is None else max(0, len(missing) - count)
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while True:
+                missing = [slot for slot in missing if not self._is_set(attr, slot)]
+                if len(missing) <= allowed:
+                    return True
+                if deadline is None:
+                    self._cond.wait()
+                elif not self._cond.wait(max(0, deadline - time.time())):
+                    return False
@@ -1,24 +1,27 @@
 # Import python libs
+import time
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
-# Import Salt Libs
-import salt.crypt
-import salt.transport.client
-import salt.serializers.msgpack
+# Import legion libs
+import legion.channel
+import legion.crypt
+import legion.payload
+import legion.spool
+import legion.stats
+import legion.targeting
+import legion.timing
 
 log = logging.getLogger(__name__)
 
 
-def returner(ret):
-    log.error(ret)
-    if ret["fun"].startswith("legion"):
-        return
-    channel = salt.transport.client.ReqChannel.factory(__opts__)
-    for ind in range(__opts__.get("legion_fakes", 10)):
-        id_ = "{}_{}".format(__opts__["id"], ind)
-        load = {
+def _return_template(ret):
+    """
+    Serialize the part of the ``_return`` load that is the same for every fake
+    """
+    return legion.payload.Template(
+        {
             "cmd": "_return",
-            "id": id_,
             "jid": ret[u"jid"],
             "fun": ret[u"fun"],
             "fun_args": ret.get(u"fun_args", []),
@@ -26,12 +29,155 @@ def returner(ret):
             "retcode": ret[u"retcode"],
             "success": ret[u"success"],
         }
-        if __opts__["minion_sign_messages"]:
+    )
+
+
+def _signed(payload, sig):
+    """
+    Add the signature of a serialized load to it
+    """
+    return legion.payload.extend(payload, {"sig": sig})
+
+
+def returner(ret):
+    """
+    Send the return of the real minion on behalf of every fake minion.
+
+    With ``legion_targeting`` on, only the fakes the job was targeted at
+    return.
+
+    With ``legion_spool`` on, the return is appended once to the minion's
+    return spool and the job is done, a background drainer sends it for the
+    fakes. Otherwise it is sent right away, see ``send``.
+    """
+    log.debug("Returning job %s (%s) for the legion fakes", ret["jid"], ret["fun"])
+    if ret["fun"].startswith("legion"):
+        return
+    if __opts__.get("legion_spool", False):
+        ids = None
+        if __opts__.get("legion_targeting", False):
+            # The publish is gone from the proc directory by the time the
+            # drainer gets to the job
+            ids = legion.targeting.matching_fakes(__opts__, ret["jid"])
+        legion.spool.spool(__opts__, ret, ids)
+        return
+    send(ret)
+
+
+class Sender(object):
+    """
+    Send the return of the real minion on behalf of one fake at a time.
+
+    The part of the load shared by all fakes is serialized once, each fake
+    only adds its id to those bytes. The result is both signed, when
+    ``minion_sign_messages`` is on, and sent over a channel borrowed from the
+    process wide channel pool, which keeps ``window`` channels for the
+    returns in flight at once.
+    """
+
+    def __init__(self, ret, window=1):
+        self.stats = legion.stats.get(__opts__)
+        self.pool = legion.channel.get_pool(__opts__)
+        self.pool.reserve(window)
+        self.template = _return_template(ret)
+        self.sign = __opts__["minion_sign_messages"]
+        self.key = None
+        if self.sign:
             log.trace("Signing event to be published onto the bus.")
-            minion_privkey_path = os.path.join(__opts__["pki_dir"], "minion.pem")
-            sig = salt.crypt.sign_message(
-                minion_privkey_path, salt.serializers.msgpack.serialize(load)
-            )
-            load["sig"] = sig
-        master_ret = channel.send(load, timeout=30)
-    channel.close()
+            self.key = legion.crypt.private_key(__opts__)
+
+    def sign_all(self, ids, workers=1, chunk=None):
+        """
+        Sign the loads of all ``ids`` up front, see ``legion.crypt.sign_many``
+        """
+        return legion.crypt.sign_many(
+            self.key,
+            (self.template.render({"id": id_}) for id_ in ids),
+            workers,
+            chunk,
+        )
+
+    def __call__(self, id_, sig=None):
+        """
+        Send the return of ``id_``, with its ``sig`` when already signed.
+        Returns ``id_`` when the return could not be sent.
+        """
+        try:
+            payload = self.template.render({"id": id_})
+            if sig is not None:
+                payload = _signed(payload, sig)
+            elif self.sign:
+                payload = _signed(payload, legion.crypt.sign(self.key, payload))
+            sent = time.time()
+            self.pool.send_serialized(payload, timeout=30)
+            self.stats.observe("return_send", time.time() - sent)
+            self.stats.incr("returns_sent")
+        except Exception as exc:  # pylint: disable=broad-except
+            self.stats.incr("returns_failed")
+            log.error("Failed to send the return of %s: %s", id_, exc)
+            return id_
+        return None
+
+
+def sender(ret, window=1):
+    """
+    Return a ``Sender`` of the return of the real minion, for callers that
+    time the returns of the fakes themselves such as the spool drainer
+    """
+    return Sender(ret, window)
+
+
+def timing(ret):
+    """
+    Return the timing of the fakes' returns of the job ``ret``, drawn from a
+    generator seeded with the minion and job ids so a job is timed the same
+    way every time it is sent
+    """
+    return legion.timing.ReturnTiming.from_opts(
+        __opts__, "{0}:{1}".format(__opts__["id"], ret["jid"])
+    )
+
+
+def send(ret, ids=None, timed=True):
+    """
+    Send the return of the real minion on behalf of the fakes ``ids``, the
+    fakes the job was targeted at when None. Returns the ids of the fakes
+    whose return could not be sent.
+
+    When ``timed``, every fake returns when the timing model of the
+    ``legion_return_*`` options says, see ``timing``.
+
+    Up to ``legion_return_window`` returns are kept in flight at once, each
+    over its own channel, so one slow reply from the master does not hold
+    back the remaining fakes. See ``Sender`` for how every return is
+    serialized and signed. With ``legion_sign_batch`` all loads are signed up
+    front over ``legion_sign_workers`` threads, ``legion_return_window`` of
+    them at a time, before the first one is sent.
+
+    How long every send and the whole job took is recorded in the stats of
+    ``legion_stats_dir``.
+    """
+    stats = legion.stats.get(__opts__)
+    start = time.time()
+    window = max(1, __opts__.get("legion_return_window", 1))
+    if ids is None:
+        ids = legion.targeting.matching_fakes(__opts__, ret["jid"])
+    returns = Sender(ret, window)
+    sigs = None
+    if returns.sign and __opts__.get("legion_sign_batch", False):
+        sigs = returns.sign_all(ids, __opts__.get("legion_sign_workers", 1), window)
+
+    def _send(ind):
+        return returns(ids[ind], None if sigs is None else sigs[ind])
+
+    return_timing = timing(ret) if timed else legion.timing.ReturnTiming()
+    with ThreadPoolExecutor(max_workers=window) as executor:
+        futures, dropped = legion.timing.dispatch(
+            executor, _send, range(len(ids)), return_timing
+        )
+        failed = [id_ for id_ in (future.result() for future in futures) if id_]
+    if dropped:
+        stats.incr("returns_dropped", len(dropped))
+    stats.observe("return_job", time.time() - start)
+    stats.flush()
+    return failed
@@ -0,0 +1,381 @@
+"""
+Spool the job returns of a legion minion to disk, for a background drainer
+process to send on behalf of the fakes, so a job does not wait on the master
+to take every fake's return
+"""
+# Import python libs
+import os
+import sys
+import mmap
+import time
+import fcntl
+import heapq
+import struct
+import logging
+import itertools
+import subprocess
+import collections
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# Import salt libs
+import salt.config
+import salt.loader
+import salt.minion
+import salt.serializers.msgpack
+
+# Import legion libs
+import legion.payload
+import legion.stats
+import legion.targeting
+
+log = logging.getLogger(__name__)
+
+HEADER = struct.Struct(">I")
+
+
+def spool_dir(opts):
+    """
+    Return the directory of the minion's spool
+    """
+    return opts.get("legion_spool_dir") or os.path.join(
+        opts["cachedir"], "legion_spool"
+    )
+
+
+class Spool(object):
+    """
+    An append-only file of length prefixed, msgpack serialized records, and
+    the offset up to which they were drained.
+
+    Any number of job processes append to it, one drainer reads it through a
+    memory map. Appending and compacting hold an exclusive lock on the file.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.join(path, "returns")
+        self.offset_path = os.path.join(path, "offset")
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def append(self, record):
+        """
+        Append a record, with one write so it is never interleaved with the
+        records of other job processes
+        """
+        data = legion.payload.serialize(record)
+        with open(self.path, "ab") as fp_:
+            fcntl.flock(fp_, fcntl.LOCK_EX)
+            try:
+                fp_.write(HEADER.pack(len(data)) + data)
+            finally:
+                fcntl.flock(fp_, fcntl.LOCK_UN)
+
+    def size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def offset(self):
+        """
+        Return the offset of the first record not drained yet
+        """
+        try:
+            with open(self.offset_path) as fp_:
+                return int(fp_.read().strip() or 0)
+        except (IOError, OSError, ValueError):
+            return 0
+
+    def commit(self, offset):
+        """
+        Record that every record before ``offset`` is drained
+        """
+        tmp = self.offset_path + ".tmp"
+        with open(tmp, "w") as fp_:
+            fp_.write(str(offset))
+        os.rename(tmp, self.offset_path)
+
+    def backlog(self):
+        """
+        Return how many bytes of records are waiting to be drained
+        """
+        return max(0, self.size() - self.offset())
+
+    def records(self, offset):
+        """
+        Yield every complete record after ``offset`` along with the offset of
+        the record that follows it
+        """
+        size = self.size()
+        if size <= offset:
+            return
+        with open(self.path, "rb") as fp_:
+            view = mmap.mmap(fp_.fileno(), size, access=mmap.ACCESS_READ)
+            try:
+                while offset + HEADER.size <= size:
+                    (length,) = HEADER.unpack_from(view, offset)
+                    end = offset + HEADER.size + length
+                    if end > size:
+                        # Still being written
+                        return
+                    record = salt.serializers.msgpack.deserialize(
+                        view[offset + HEADER.size : end]
+                    )
+                    offset = end
+                    yield offset, record
+            finally:
+                view.close()
+
+    def compact(self):
+        """
+        Empty the spool once every record in it is drained, returns whether
+        it was emptied
+        """
+        with open(self.path, "ab") as fp_:
+            fcntl.flock(fp_, fcntl.LOCK_EX)
+            try:
+                if fp_.tell() == self.offset():
+                    fp_.truncate(0)
+                    self.commit(0)
+                    return True
+                return False
+            finally:
+                fcntl.flock(fp_, fcntl.LOCK_UN)
+
+
+def spool(opts, ret, ids=None):
+    """
+    Append a job return to the minion's spool and make sure a drainer is
+    running. ``ids`` are the fakes to return for, all of them when None.
+
+    When more than ``legion_spool_max_backlog`` bytes wait to be drained the
+    master is not keeping up, and the return is shed instead.
+    """
+    path = spool_dir(opts)
+    queue = Spool(path)
+    if queue.backlog() > opts.get("legion_spool_max_backlog", 64 * 2 ** 20):
+        log.warning("The return spool is full, shedding job %s", ret["jid"])
+        legion.stats.get(opts).incr("spool_shed")
+        return False
+    queue.append({"ret": ret, "ids": ids, "time": time.time()})
+    ensure_drainer(opts, path)
+    return True
+
+
+def ensure_drainer(opts, path):
+    """
+    Start the drainer of the spool in ``path`` unless one holds its lock
+    """
+    with open(os.path.join(path, "drainer.lock"), "a") as fp_:
+        try:
+            fcntl.flock(fp_, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            return
+        fcntl.flock(fp_, fcntl.LOCK_UN)
+    cmd = [sys.executable, "-m", "legion.spool", opts["conf_file"]]
+    if opts.get("master_uri"):
+        # The master the minion is connected to, the config only names it
+        cmd.append(opts["master_uri"])
+    with open(os.devnull, "w") as devnull:
+        subprocess.Popen(
+            cmd,
+            stdout=devnull,
+            stderr=devnull,
+            close_fds=True,
+            start_new_session=True,
+        )
+
+
+class _Job(object):
+    """
+    A spooled job being drained: its sender, and the fakes left to send and
+    failed in the current attempt
+    """
+
+    def __init__(self, record, end):
+        self.record = record
+        self.end = end
+        self.send = None
+        self.left = 0
+        self.failed = []
+        self.attempt = 0
+        self.done = False
+
+
+class Drainer(object):
+    """
+    Send the spooled returns to the master through the ``legion`` returner,
+    loaded in its direct mode.
+
+    Every fake of every spooled job returns when the timing model of the
+    ``legion_return_*`` options says, counted from when the job was spooled.
+    The due returns of all jobs go out from one heap, up to
+    ``legion_return_window`` at once, so the returns of jobs spooled close
+    together overlap as they would coming from the minion, and a slow master
+    slows the drain rather than piling up requests.
+
+    The fakes whose return failed are retried ``legion_spool_retries`` times,
+    waiting ``legion_spool_backoff`` seconds and doubling that wait after every
+    failure. Jobs spooled more than ``legion_spool_max_age`` seconds ago are
+    shed, the master has long stopped waiting for them. A job counts as
+    drained once all its fakes returned or were given up on. The drainer
+    exits after ``legion_spool_idle`` seconds without returns to send.
+    """
+
+    def __init__(self, opts):
+        self.opts = dict(opts)
+        self.opts["legion_spool"] = False
+        self.path = spool_dir(opts)
+        self.queue = Spool(self.path)
+        self.returners = salt.loader.returners(self.opts, {})
+        self.stats = legion.stats.get(self.opts)
+        self.window = max(1, self.opts.get("legion_return_window", 1))
+        self.read = self.queue.offset()
+        # The jobs in spool order, to tell up to where the spool is drained
+        self.jobs = collections.deque()
+        self.heap = []
+        self.futures = set()
+        self._seq = itertools.count()
+
+    def run(self):
+        lock = open(os.path.join(self.path, "drainer.lock"), "a")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            # Another drainer beat us to it
+            return
+        poll = self.opts.get("legion_spool_poll", 0.5)
+        idle = self.opts.get("legion_spool_idle", 300)
+        last = time.time()
+        with ThreadPoolExecutor(max_workers=self.window) as executor:
+            while self.jobs or time.time() - last < idle:
+                for offset, record in self.queue.records(self.read):
+                    self.read = offset
+                    self.schedule(record, offset)
+                self.submit(executor)
+                timeout = poll
+                if self.heap:
+                    timeout = min(poll, max(0.0, self.heap[0][0] - time.time()))
+                if self.futures:
+                    done, self.futures = wait(
+                        self.futures, timeout, return_when=FIRST_COMPLETED
+                    )
+                    for future in done:
+                        self.returned(*future.result())
+                elif timeout:
+                    time.sleep(timeout)
+                if self.jobs:
+                    last = time.time()
+                self.commit()
+        lock.close()
+        if self.queue.backlog():
+            # Spooled after the last look, while the lock was still held
+            ensure_drainer(self.opts, self.path)
+
+    def schedule(self, record, end):
+        """
+        Queue the returns of every fake of a spooled job for when they are
+        due, counted from when the job was spooled
+        """
+        ret, ids = record["ret"], record["ids"]
+        job = _Job(record, end)
+        self.jobs.append(job)
+        if time.time() - record["time"] > self.opts.get("legion_spool_max_age", 300):
+            log.warning("Shedding job %s, it waited too long", ret["jid"])
+            self.stats.incr("spool_shed")
+            job.done = True
+            return
+        if ids is None:
+            ids = legion.targeting.matching_fakes(self.opts, ret["jid"])
+        job.send = self.returners["legion.sender"](ret, self.window)
+        timing = self.returners["legion.timing"](ret)
+        for id_ in ids:
+            due = timing.draw()
+            if due is None:
+                self.stats.incr("returns_dropped")
+                continue
+            self.push(record["time"] + due, job, id_)
+        if not job.left:
+            self.finish(job)
+
+    def push(self, due, job, id_):
+        heapq.heappush(self.heap, (due, next(self._seq), job, id_))
+        job.left += 1
+
+    def submit(self, executor):
+        """
+        Send the due returns, keeping at most ``window`` of them in flight
+        """
+        now = time.time()
+        while self.heap and self.heap[0][0] <= now and len(self.futures) < self.window:
+            _, _, job, id_ = heapq.heappop(self.heap)
+            self.futures.add(executor.submit(self.send, job, id_))
+
+    @staticmethod
+    def send(job, id_):
+        return job, job.send(id_)
+
+    def returned(self, job, failed):
+        """
+        Account for one sent return of ``job``, ``failed`` holds the id of
+        the fake when it could not be sent
+        """
+        job.left -= 1
+        if failed:
+            job.failed.append(failed)
+        if not job.left:
+            self.finish(job)
+
+    def finish(self, job):
+        """
+        Retry the fakes of the job whose returns failed, or mark it drained
+        """
+        failed, job.failed = job.failed, []
+        jid = job.record["ret"]["jid"]
+        if failed and job.attempt < self.opts.get("legion_spool_retries", 3):
+            job.attempt += 1
+            self.stats.incr("spool_retries", len(failed))
+            due = time.time() + self.opts.get("legion_spool_backoff", 1.0) * 2 ** (
+                job.attempt - 1
+            )
+            for id_ in failed:
+                self.push(due, job, id_)
+            return
+        if failed:
+            log.error("Gave up on %s returns of job %s", len(failed), jid)
+            self.stats.incr("spool_failed", len(failed))
+        job.done = True
+        self.stats.observe("spool_lag", time.time() - job.record["time"])
+        self.stats.flush()
+
+    def commit(self):
+        """
+        Record the spool as drained up to the first job still being drained,
+        and empty it once every job in it is
+        """
+        offset = None
+        while self.jobs and self.jobs[0].done:
+            offset = self.jobs.popleft().end
+        if offset is None:
+            return
+        self.queue.commit(offset)
+        if not self.jobs and self.queue.compact():
+            self.read = 0
+
+
+def main(conf_file, master_uri=None):
+    opts = salt.config.minion_config(conf_file)
+    if master_uri:
+        opts["master_uri"] = master_uri
+    else:
+        opts.update(salt.minion.resolve_dns(opts))
+    logging.basicConfig(
+        filename=os.path.join(spool_dir(opts), "drainer.log"),
+        level=logging.WARNING,
+        format="%(asctime)s [%(name)s][%(levelname)s] %(message)s",
+    )
+    Drainer(opts).run()
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:3])
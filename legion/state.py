@@ -0,0 +1,80 @@
+"""
+The provisioning state of a swarm, kept in its swarm root so a restarted
+swarm can skip what it already did
+"""
+# Import python libs
+import os
+import json
+import time
+import hashlib
+import threading
+
+STATE_FILE = "legion-state.json"
+
+
+def fingerprint(text):
+    """
+    Return a short fingerprint of what a stage was run against
+    """
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class SwarmState(object):
+    """
+    Which provisioning stages every minion of the swarm went through, and
+    against what. A stage counts as done for a minion only when it was run
+    against the same fingerprint, so changing the swarm's options redoes the
+    stages they affect.
+
+    Without ``resume`` the state on disk is ignored and overwritten.
+    """
+
+    def __init__(self, swarm_root, resume=False, interval=1.0):
+        self.path = os.path.join(swarm_root, STATE_FILE)
+        self.interval = interval
+        self.minions = {}
+        self._lock = threading.Lock()
+        self._saved = 0
+        if resume and os.path.exists(self.path):
+            with open(self.path) as fp_:
+                self.minions = json.load(fp_).get("minions", {})
+
+    def done(self, minion, stage, print_):
+        """
+        Tell whether ``stage`` was already run for ``minion`` against the
+        fingerprint ``print_``
+        """
+        with self._lock:
+            return self.minions.get(minion, {}).get(stage) == print_
+
+    def mark(self, minion, stage, print_):
+        """
+        Record that ``stage`` was run for ``minion`` against the fingerprint
+        ``print_``
+        """
+        with self._lock:
+            self.minions.setdefault(minion, {})[stage] = print_
+        self.save()
+
+    def count(self, stage):
+        """
+        Return how many minions went through ``stage``
+        """
+        with self._lock:
+            return sum(1 for stages in self.minions.values() if stage in stages)
+
+    def save(self, force=False):
+        """
+        Write the state out, at most once every ``interval`` seconds unless
+        forced
+        """
+        with self._lock:
+            now = time.time()
+            if not force and now - self._saved < self.interval:
+                return
+            self._saved = now
+            data = json.dumps({"minions": self.minions})
+        tmp = "{0}.{1}.tmp".format(self.path, threading.current_thread().ident)
+        with open(tmp, "w") as fp_:
+            fp_.write(data)
+        os.rename(tmp, self.path)
@@ -0,0 +1,350 @@
+"""
+Counters and latency histograms of the phases legion goes through, kept per
+process and merged across all the minion processes of a swarm, so it shows
+whether the master or legion itself is the bottleneck
+"""
+# Import python libs
+import os
+import json
+import time
+import fcntl
+import atexit
+import threading
+import contextlib
+
+# The bits of precision every histogram bucket keeps, values are within
+# 1 / 2 ** (SUB_BITS - 1) of what was recorded
+SUB_BITS = 7
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+_STATS = {}
+_STATS_LOCK = threading.Lock()
+
+
+class Histogram(object):
+    """
+    A latency histogram in the manner of HdrHistogram: every value, in
+    microseconds, falls in a bucket made of its ``SUB_BITS`` most significant
+    bits and how far they are shifted. Recording is a dict update, and
+    histograms merge by adding up their buckets.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = {}
+
+    def record(self, seconds):
+        """
+        Add one value, in seconds
+        """
+        value = max(1, int(seconds * 1e6))
+        shift = max(0, value.bit_length() - SUB_BITS)
+        key = (shift << SUB_BITS) | (value >> shift)
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+        self.count += 1
+        self.sum += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        """
+        Add the values of another histogram to this one
+        """
+        for key, count in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+        self.count += other.count
+        self.sum += other.sum
+        for attr, pick in (("min", min), ("max", max)):
+            theirs = getattr(other, attr)
+            if theirs is not None:
+                mine = getattr(self, attr)
+                setattr(self, attr, theirs if mine is None else pick(mine, theirs))
+
+    def quantile(self, quantile):
+        """
+        Return the value, in seconds, below which ``quantile`` of the values
+        fall
+        """
+        if not self.count:
+            return 0.0
+        rank = quantile * self.count
+        seen = 0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if seen >= rank:
+                shift, value = key >> SUB_BITS, key & ((1 << SUB_BITS) - 1)
+                # The middle of the bucket, within what was recorded
+                mid = ((value << shift) + ((1 << shift) - 1) / 2.0) / 1e6
+                if self.min is not None:
+                    mid = min(max(mid, self.min), self.max)
+                return mid
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min,
+            "max": self.max,
+            "buckets": dict((str(key), val) for key, val in self.buckets.items()),
+        }
+
+    def since(self, earlier):
+        """
+        Return a histogram of the values recorded since the ``earlier`` copy
+        of this histogram was taken. It does not know its extremes.
+        """
+        hist = Histogram()
+        hist.count = self.count - earlier.count
+        hist.sum = self.sum - earlier.sum
+        for key, count in self.buckets.items():
+            count -= earlier.buckets.get(key, 0)
+            if count > 0:
+                hist.buckets[key] = count
+        return hist
+
+    @classmethod
+    def from_dict(cls, data):
+        hist = cls()
+        hist.count = data["count"]
+        hist.sum = data["sum"]
+        hist.min = data["min"]
+        hist.max = data["max"]
+        hist.buckets = dict((int(key), val) for key, val in data["buckets"].items())
+        return hist
+
+
+class Stats(object):
+    """
+    The counters and histograms of one process for the minion ``owner``. On
+    every ``flush`` what was recorded since the last one is added to the
+    owner's file in ``stats_dir``, which all processes of the minion share,
+    so there is one file per minion however many job processes it forks.
+    Without a ``stats_dir`` they are only kept in memory.
+    """
+
+    def __init__(self, stats_dir=None, owner=None):
+        self.stats_dir = stats_dir
+        self.owner = owner
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+
+    def incr(self, name, count=1):
+        """
+        Add ``count`` to the counter ``name``
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+            self._dirty = True
+
+    def observe(self, phase, seconds):
+        """
+        Record how many ``seconds`` one pass through ``phase`` took
+        """
+        with self._lock:
+            hist = self.histograms.get(phase)
+            if hist is None:
+                hist = self.histograms[phase] = Histogram()
+            hist.record(seconds)
+            self._dirty = True
+
+    @contextlib.contextmanager
+    def timer(self, phase):
+        """
+        Record how long the with block took as one pass through ``phase``
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.time() - start)
+
+    def to_dict(self):
+        with self._lock:
+            return _dump(self.owner, self.counters, self.histograms)
+
+    def flush(self):
+        """
+        Add what was recorded since the last flush to the owner's file
+        """
+        if not self.stats_dir:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            counters, histograms = self.counters, self.histograms
+            self.counters, self.histograms = {}, {}
+            self._dirty = False
+        path = os.path.join(self.stats_dir, "{0}.json".format(self.owner or "legion"))
+        try:
+            if not os.path.exists(self.stats_dir):
+                os.makedirs(self.stats_dir)
+            with open(path + ".lock", "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    merged = ({}, {})
+                    if os.path.exists(path):
+                        with open(path) as fp_:
+                            _merge(merged, json.load(fp_))
+                    _add(merged, counters, histograms)
+                    write_atomic(path, json.dumps(_dump(self.owner, *merged)))
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+        except (IOError, OSError, ValueError):
+            # Keep them for the next flush
+            with self._lock:
+                _add((self.counters, self.histograms), counters, histograms)
+                self._dirty = True
+
+
+def get(opts):
+    """
+    Return the stats of this process for the minion and ``legion_stats_dir``
+    in ``opts``, creating them on first use. Like the channel pools, stats are
+    per process so a forked job process does not write over its parent's.
+    """
+    key = (os.getpid(), opts.get("legion_stats_dir"), opts.get("id"))
+    with _STATS_LOCK:
+        stats = _STATS.get(key)
+        if stats is None:
+            for stale in [k for k in _STATS if k[0] != key[0]]:
+                del _STATS[stale]
+            stats = _STATS[key] = Stats(key[1], key[2])
+    return stats
+
+
+@atexit.register
+def flush_all():
+    """
+    Flush every set of stats owned by this process
+    """
+    with _STATS_LOCK:
+        stats = [val for key, val in _STATS.items() if key[0] == os.getpid()]
+    for val in stats:
+        val.flush()
+
+
+def _dump(owner, counters, histograms):
+    return {
+        "owner": owner,
+        "counters": dict(counters),
+        "histograms": dict(
+            (phase, hist.to_dict()) for phase, hist in histograms.items()
+        ),
+    }
+
+
+def _load(stats_dir):
+    """
+    Yield the stats of every minion in ``stats_dir``
+    """
+    try:
+        names = os.listdir(stats_dir)
+    except (IOError, OSError):
+        names = []
+    for name in names:
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(stats_dir, name)) as fp_:
+                yield json.load(fp_)
+        except (IOError, OSError, ValueError):
+            continue
+
+
+def _add(merged, counters, histograms):
+    for counter, count in counters.items():
+        merged[0][counter] = merged[0].get(counter, 0) + count
+    for phase, hist in histograms.items():
+        merged[1].setdefault(phase, Histogram()).merge(hist)
+
+
+def _merge(merged, data):
+    _add(
+        merged,
+        data["counters"],
+        dict(
+            (phase, Histogram.from_dict(hist))
+            for phase, hist in data["histograms"].items()
+        ),
+    )
+
+
+def collect(stats_dir):
+    """
+    Merge the stats of every minion in ``stats_dir``
+    """
+    merged = ({}, {})
+    for data in _load(stats_dir):
+        _merge(merged, data)
+    return merged
+
+
+def collect_by_owner(stats_dir):
+    """
+    Return the stats of every minion in ``stats_dir`` by minion id
+    """
+    owners = {}
+    for data in _load(stats_dir):
+        _merge(owners.setdefault(data.get("owner"), ({}, {})), data)
+    return owners
+
+
+def report(counters, histograms):
+    """
+    Summarize merged stats: every counter, and the count, mean, extremes and
+    quantiles of every phase in seconds
+    """
+    phases = {}
+    for phase, hist in histograms.items():
+        phases[phase] = {
+            "count": hist.count,
+            "mean": hist.sum / hist.count if hist.count else 0.0,
+            "min": hist.min,
+            "max": hist.max,
+        }
+        for quantile in QUANTILES:
+            phases[phase]["p{0:g}".format(quantile * 100)] = hist.quantile(quantile)
+    return {"counters": counters, "phases": phases}
+
+
+def prometheus(counters, histograms, prefix="legion"):
+    """
+    Render merged stats in the Prometheus text format: a counter for every
+    counter and a summary of every phase
+    """
+    lines = []
+    for counter in sorted(counters):
+        name = "{0}_{1}_total".format(prefix, counter)
+        lines.append("# TYPE {0} counter".format(name))
+        lines.append("{0} {1}".format(name, counters[counter]))
+    for phase in sorted(histograms):
+        hist = histograms[phase]
+        name = "{0}_{1}_seconds".format(prefix, phase)
+        lines.append("# TYPE {0} summary".format(name))
+        for quantile in QUANTILES:
+            lines.append(
+                '{0}{{quantile="{1:g}"}} {2:.6f}'.format(
+                    name, quantile, hist.quantile(quantile)
+                )
+            )
+        lines.append("{0}_sum {1:.6f}".format(name, hist.sum))
+        lines.append("{0}_count {1}".format(name, hist.count))
+    return "\n".join(lines) + "\n"
+
+
+def write_atomic(path, text):
+    """
+    Replace the file at ``path`` with ``text`` in one step, so readers such
+    as the node exporter never see half of it
+    """
+    with open(path + ".tmp", "w") as fp_:
+        fp_.write(text)
+    os.rename(path + ".tmp", path)
@@ -0,0 +1,221 @@
+"""
+A stand-in for the salt master that answers legion's requests over the real
+ZeroMQ request transport, with an artificial latency, so legion's own
+throughput can be measured without a master. Requests reach it through
+salt's channels, serialization and AES exactly as they would reach a master.
+"""
+# Import python libs
+import os
+import time
+import ctypes
+import random
+import hashlib
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+# Import salt libs
+import salt.crypt
+import salt.payload
+import salt.utils.files
+import salt.utils.stringutils
+
+# Import legion libs
+import legion.crypt
+
+# Import third party libs
+import zmq
+
+log = logging.getLogger(__name__)
+
+COMMANDS = ("_auth", "_return", "_pillar")
+
+
+class StubMaster(object):
+    """
+    Answer the requests of salt's ReqChannels the way a master with
+    ``auto_accept`` would, after ``latency`` seconds give or take up to
+    ``jitter`` seconds:
+
+    _auth
+        accept the key and hand out the AES key, encrypted for the minion key
+        and signed with the master key in ``pki_dir``
+    _return
+        take the return
+    _pillar
+        compile an empty pillar
+
+    The minion and all its fakes share the minion key in ``pki_dir``. The
+    stub listens on a random port of 127.0.0.1 from its own process, so its
+    work is not counted against the process being measured, and answers up
+    to ``workers`` requests at once. It counts the requests and the bytes of
+    every command.
+    """
+
+    def __init__(self, pki_dir, latency=0.0, jitter=0.0, seed=None, workers=64):
+        self.pki_dir = pki_dir
+        self.latency = latency
+        self.jitter = jitter
+        self.seed = seed
+        self.workers = workers
+        self.port = multiprocessing.RawValue(ctypes.c_int, 0)
+        self._counts = dict(
+            (cmd, multiprocessing.RawValue(ctypes.c_long, 0)) for cmd in COMMANDS
+        )
+        self._bytes = dict(
+            (cmd, multiprocessing.RawValue(ctypes.c_long, 0)) for cmd in COMMANDS
+        )
+        self._ready = multiprocessing.Event()
+        self._process = None
+
+    @property
+    def uri(self):
+        return "tcp://127.0.0.1:{0}".format(self.port.value)
+
+    @property
+    def counts(self):
+        return dict((cmd, val.value) for cmd, val in self._counts.items())
+
+    @property
+    def bytes(self):
+        return dict((cmd, val.value) for cmd, val in self._bytes.items())
+
+    def reset(self):
+        """
+        Forget the requests counted so far
+        """
+        for val in list(self._counts.values()) + list(self._bytes.values()):
+            val.value = 0
+
+    def start(self):
+        """
+        Start answering requests, returns once the stub listens
+        """
+        self._process = multiprocessing.Process(target=self._serve)
+        self._process.daemon = True
+        self._process.start()
+        if not self._ready.wait(30):
+            self.stop()
+            raise RuntimeError("The stub master did not come up")
+
+    def stop(self):
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _serve(self):
+        """
+        Take the requests off a ROUTER socket, answer them from a pool of
+        threads and send their replies back from the socket's own thread
+        """
+        self._setup()
+        context = zmq.Context()
+        router = context.socket(zmq.ROUTER)
+        self.port.value = router.bind_to_random_port("tcp://127.0.0.1")
+        replies = context.socket(zmq.PULL)
+        replies.bind("inproc://replies")
+        local = threading.local()
+
+        def _answer(frames):
+            try:
+                reply = self.handle(frames[-1])
+            except Exception:  # pylint: disable=broad-except
+                log.exception("The stub master failed to answer a request")
+                reply = self._serial.dumps("Server-side exception handling payload")
+            push = getattr(local, "push", None)
+            if push is None:
+                push = local.push = context.socket(zmq.PUSH)
+                push.connect("inproc://replies")
+            push.send_multipart(frames[:-1] + [reply])
+
+        poller = zmq.Poller()
+        poller.register(router, zmq.POLLIN)
+        poller.register(replies, zmq.POLLIN)
+        self._ready.set()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while True:
+                for sock, _ in poller.poll():
+                    if sock is router:
+                        executor.submit(_answer, router.recv_multipart())
+                    else:
+                        router.send_multipart(replies.recv_multipart())
+
+    def _setup(self):
+        """
+        Load the keys and make the AES key of this run of the stub
+        """
+        self._rand = random.Random(self.seed)
+        self._lock = threading.Lock()
+        self._serial = salt.payload.Serial({})
+        self._master_key = salt.crypt.get_rsa_key(
+            os.path.join(self.pki_dir, "master.pem"), None
+        )
+        with salt.utils.files.fopen(os.path.join(self.pki_dir, "master.pub")) as fp_:
+            self._master_pub = fp_.read()
+        self._minion_pub = salt.crypt.get_rsa_pub_key(
+            os.path.join(self.pki_dir, "minion.pub")
+        )
+        self._aes = salt.crypt.Crypticle.generate_key_string()
+        self._crypticle = salt.crypt.Crypticle({}, self._aes)
+
+    def _wait(self, cmd, size):
+        with self._lock:
+            if cmd in self._counts:
+                self._counts[cmd].value += 1
+                self._bytes[cmd].value += size
+            delay = self.latency
+            if self.jitter:
+                delay += self._rand.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def handle(self, data):
+        """
+        Answer one serialized request with the serialized reply
+        """
+        payload = self._serial.loads(data)
+        load = payload.get("load")
+        if payload.get("enc") == "aes":
+            load = self._crypticle.loads(load)
+        cmd = load.get("cmd") if isinstance(load, dict) else None
+        self._wait(cmd, len(data))
+        if cmd == "_auth":
+            return self._serial.dumps(self._auth(load))
+        if cmd == "_pillar":
+            return self._serial.dumps(self._private({}, "pillar"))
+        return self._serial.dumps(self._crypticle.dumps(True))
+
+    def _auth(self, load):
+        """
+        Accept a sign in, the way the master's ``_auth`` does
+        """
+        aes = salt.utils.stringutils.to_bytes(self._aes)
+        ret = {"enc": "pub", "pub_key": self._master_pub, "publish_port": 4505}
+        if "token" in load:
+            token = legion.crypt.decrypt(self._master_key, load["token"])
+            ret["token"] = legion.crypt.encrypt(self._minion_pub, token)
+        ret["aes"] = legion.crypt.encrypt(self._minion_pub, aes)
+        digest = salt.utils.stringutils.to_bytes(hashlib.sha256(aes).hexdigest())
+        ret["sig"] = salt.crypt.private_encrypt(self._master_key, digest)
+        return ret
+
+    def _private(self, ret, dictkey):
+        """
+        Encrypt a reply for the minion alone, the way the master sends pillars
+        """
+        key = salt.crypt.Crypticle.generate_key_string()
+        return {
+            "key": legion.crypt.encrypt(
+                self._minion_pub, salt.utils.stringutils.to_bytes(key)
+            ),
+            dictkey: salt.crypt.Crypticle({}, key).dumps(ret),
+        }
@@ -0,0 +1,277 @@
+"""
+Find the point where the master stops keeping up: raise the number of active
+fakes of a running swarm step by step, time a probe job at every step and stop
+once the returns miss their objectives
+"""
+# Import python libs
+from __future__ import absolute_import, print_function
+import os
+import csv
+import json
+import time
+import optparse
+
+# Import salt libs
+import salt.utils.files
+
+# Import legion libs
+import legion.bench
+import legion.fakes
+
+COLUMNS = (
+    "step",
+    "fakes",
+    "ids",
+    "jobs",
+    "completeness",
+    "first_p50",
+    "first_p99",
+    "last_p50",
+    "last_p99",
+    "return_p50",
+    "return_p99",
+    "ok",
+)
+
+
+class Sweep(object):
+    """
+    Step the fakes of every minion of the swarm in ``temp_dir`` up from
+    ``start`` by ``step`` to ``legion``, probing the master at every step
+    """
+
+    def __init__(self, opts):
+        self.opts = opts
+        self.bench = legion.bench.Bench(opts)
+        zfill = len(str(opts["minions"]))
+        self.cachedirs = [
+            os.path.join(
+                opts["temp_dir"],
+                "{0}-{1}".format(opts["name"], str(idx).zfill(zfill)),
+                "cache",
+            )
+            for idx in range(opts["minions"])
+        ]
+
+    def set_fakes(self, count):
+        """
+        Have every minion of the swarm return for ``count`` fakes
+        """
+        for cachedir in self.cachedirs:
+            legion.fakes.set_active({"cachedir": cachedir}, count)
+
+    def measure(self, idx, fakes):
+        """
+        Probe the master with ``fakes`` active fakes per minion and return the
+        point of the curve
+        """
+        self.set_fakes(fakes)
+        time.sleep(self.opts["settle"])
+        ids = self.opts["minions"] * (fakes + 1)
+        self.bench.active = fakes
+        run = self.bench.run()["run"]
+        point = {
+            "step": idx,
+            "fakes": fakes,
+            "ids": ids,
+            "jobs": run["jobs"],
+            "completeness": 1.0 - run["missing"] / float(run["expected"] or 1),
+        }
+        for name in ("first", "last", "return"):
+            point["{0}_p50".format(name)] = run[name]["p50"]
+            point["{0}_p99".format(name)] = run[name]["p99"]
+        point["ok"] = bool(
+            run["jobs"]
+            and point["completeness"] >= self.opts["slo_completeness"]
+            and point["last_p99"] <= self.opts["slo_p99"]
+        )
+        return point
+
+    def run(self):
+        """
+        Step up until a step misses the objectives or every fake is active,
+        and return the curve and its knee, the last step that met them
+        """
+        curve = []
+        knee = None
+        fakes = self.opts["start"]
+        while fakes <= self.opts["legion"]:
+            point = self.measure(len(curve), fakes)
+            curve.append(point)
+            print(
+                "{fakes} fakes a minion, {ids} ids: {completeness:.2%} of the "
+                "returns, last return {last_p50:.3f}s p50 {last_p99:.3f}s "
+                "p99".format(**point)
+            )
+            if not point["ok"]:
+                break
+            knee = point
+            fakes += self.opts["step"]
+        # Leave the swarm at the knee
+        self.set_fakes(knee["fakes"] if knee else self.opts["start"])
+        return {"knee": knee, "curve": curve, "slo": self.slo()}
+
+    def slo(self):
+        return {
+            "completeness": self.opts["slo_completeness"],
+            "last_p99": self.opts["slo_p99"],
+        }
+
+
+def parse(args):
+    """
+    Parse the cli options of ``legion sweep``
+    """
+    parser = optparse.OptionParser(usage="%prog sweep [options]")
+    parser.add_option(
+        "--temp-dir",
+        dest="temp_dir",
+        default=None,
+        help="The directory of the running swarm, as given to it with --temp-dir",
+    )
+    parser.add_option(
+        "-m",
+        "--minions",
+        dest="minions",
+        default=5,
+        type="int",
+        help="The number of minions of the swarm",
+    )
+    parser.add_option(
+        "-l",
+        "--legion",
+        dest="legion",
+        default=100,
+        type="int",
+        help="The number of legion fakes of every minion, where the sweep ends",
+    )
+    parser.add_option(
+        "--name",
+        "-n",
+        dest="name",
+        default="ms",
+        help="The id prefix of the minions of the swarm",
+    )
+    parser.add_option(
+        "--start",
+        dest="start",
+        default=10,
+        type="int",
+        help="The active fakes per minion of the first step",
+    )
+    parser.add_option(
+        "--step",
+        dest="step",
+        default=10,
+        type="int",
+        help="The active fakes per minion added at every step",
+    )
+    parser.add_option(
+        "--settle",
+        dest="settle",
+        default=5.0,
+        type="float",
+        help="Seconds to wait after every step before probing",
+    )
+    parser.add_option(
+        "-j",
+        "--job",
+        dest="job",
+        default=[],
+        action="append",
+        help="The probe job as [WEIGHT:]FUN [ARG ...], test.ping by default",
+    )
+    parser.add_option(
+        "-c",
+        "--count",
+        dest="count",
+        default=5,
+        type="int",
+        help="The number of probe jobs at every step",
+    )
+    parser.add_option(
+        "-r",
+        "--rate",
+        dest="rate",
+        default=1.0,
+        type="float",
+        help="Probe jobs published a second, 0 for no limit",
+    )
+    parser.add_option(
+        "--timeout",
+        dest="timeout",
+        default=60.0,
+        type="float",
+        help="Seconds to wait for the returns after the last probe of a step",
+    )
+    parser.add_option(
+        "--slo-p99",
+        dest="slo_p99",
+        default=10.0,
+        type="float",
+        help="The most seconds the 99th percentile of the last returns may take",
+    )
+    parser.add_option(
+        "--slo-completeness",
+        dest="slo_completeness",
+        default=0.99,
+        type="float",
+        help="The least share of the expected returns that must come back",
+    )
+    parser.add_option(
+        "--config",
+        dest="config",
+        default="/etc/salt/master",
+        help="The config of the master to publish to",
+    )
+    parser.add_option(
+        "--report",
+        dest="report",
+        default="legion-sweep.json",
+        help="The JSON file the knee and the curve are written to",
+    )
+    parser.add_option(
+        "--csv",
+        dest="csv",
+        default="legion-sweep.csv",
+        help="The CSV file the curve is written to",
+    )
+    options, _args = parser.parse_args(args)
+    if not options.temp_dir:
+        parser.error("--temp-dir of the running swarm is required")
+    if options.step <= 0:
+        parser.error("--step must add at least one fake a step")
+    if not 0 <= options.start <= options.legion:
+        parser.error("--start must be between 0 and --legion")
+    opts = dict(options.__dict__)
+    # The probe publishes like legion bench does
+    opts.update(
+        {
+            "target": "{0}-*".format(opts["name"]),
+            "tgt_type": "glob",
+            "ramp_profile": "constant",
+            "ramp_time": 0.0,
+            "seed": 0,
+        }
+    )
+    return opts
+
+
+def main(args):
+    opts = parse(args)
+    report = Sweep(opts).run()
+    knee = report["knee"]
+    if knee is None:
+        print("The first step already missed the objectives")
+    else:
+        print(
+            "Knee at {fakes} fakes a minion, {ids} ids: last return {last_p99:.3f}s "
+            "p99, {completeness:.2%} of the returns".format(**knee)
+        )
+    with salt.utils.files.fopen(opts["report"], "w") as fp_:
+        json.dump(report, fp_, indent=2, sort_keys=True)
+    with salt.utils.files.fopen(opts["csv"], "w") as fp_:
+        writer = csv.DictWriter(fp_, COLUMNS)
+        writer.writeheader()
+        writer.writerows(report["curve"])
+    print("Curve written to {0} and {1}".format(opts["report"], opts["csv"]))
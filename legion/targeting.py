@@ -0,0 +1,80 @@
+"""
+Match the target of a publish against the fakes of a legion minion, so fakes
+only return for the jobs they would have been targeted by
+"""
+# Import python libs
+import os
+import logging
+import importlib
+
+# Import salt libs
+import salt.payload
+import salt.utils.files
+
+# Import legion libs
+import legion.fakes
+
+log = logging.getLogger(__name__)
+
+# The target types fakes are matched against, other targets reach all fakes
+TGT_TYPES = ("glob", "pcre", "list", "grain", "grain_pcre", "compound")
+
+
+def match(opts, tgt, tgt_type="glob", **kwargs):
+    """
+    Match the minion with ``opts`` against the target with salt's own matcher
+    """
+    matcher = importlib.import_module("salt.matchers.{0}_match".format(tgt_type))
+    return matcher.match(tgt, opts=opts, **kwargs)
+
+
+def match_any(opts, tgt, tgt_type="glob", **kwargs):
+    """
+    Match the minion, or with ``legion_targeting`` on any of its fakes,
+    against the target
+    """
+    if match(opts, tgt, tgt_type, **kwargs):
+        return True
+    if not opts.get("legion_targeting", False):
+        return False
+    return any(
+        match(legion.fakes.fake_opts(opts, id_), tgt, tgt_type, **kwargs)
+        for id_ in legion.fakes.fake_ids(opts)
+    )
+
+
+def job_target(opts, jid):
+    """
+    Return the publish of the running job ``jid`` as the minion recorded it in
+    its proc directory, None when it is not there
+    """
+    path = os.path.join(opts["cachedir"], "proc", str(jid))
+    try:
+        with salt.utils.files.fopen(path, "rb") as fp_:
+            return salt.payload.Serial(opts).load(fp_)
+    except (IOError, OSError, ValueError) as exc:
+        log.debug("Could not read the publish of job %s: %s", jid, exc)
+        return None
+
+
+def matching_fakes(opts, jid):
+    """
+    Return the ids of the fakes the job ``jid`` was targeted at. Without
+    ``legion_targeting``, or when the target cannot be matched per fake, that
+    is all of them.
+    """
+    ids = legion.fakes.fake_ids(opts)
+    if not opts.get("legion_targeting", False):
+        return ids
+    data = job_target(opts, jid)
+    if not data or data.get("tgt_type", "glob") not in TGT_TYPES:
+        return ids
+    tgt_type = data.get("tgt_type", "glob")
+    kwargs = {}
+    if tgt_type in ("grain", "grain_pcre") and data.get("delimiter"):
+        kwargs["delimiter"] = data["delimiter"]
+    return [
+        id_
+        for id_ in ids
+        if match(legion.fakes.fake_opts(opts, id_), data["tgt"], tgt_type, **kwargs)
+    ]
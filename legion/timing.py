@@ -0,0 +1,123 @@
+"""
+When the fakes return after their job is done, so their returns reach the
+master spread out the way a fleet's would rather than in one burst
+"""
+# Import python libs
+import math
+import time
+import heapq
+import random
+
+MODELS = ("burst", "fixed", "uniform", "lognormal")
+
+
+class ReturnTiming(object):
+    """
+    Draw how many seconds after the job a fake returns:
+
+    burst
+        right away, every fake at once
+    fixed
+        after ``delay`` seconds
+    uniform
+        after ``delay`` seconds plus up to ``jitter`` seconds
+    lognormal
+        after ``delay`` seconds plus a lognormal jitter with a median of
+        ``jitter`` seconds and a shape of ``sigma``
+
+    On top of that ``slow_pct`` percent of the fakes are slow and return
+    ``slow_delay`` seconds later, and ``drop_pct`` percent of them do not
+    return at all.
+    """
+
+    def __init__(
+        self,
+        model="burst",
+        delay=0.0,
+        jitter=0.0,
+        sigma=1.0,
+        slow_pct=0.0,
+        slow_delay=0.0,
+        drop_pct=0.0,
+        seed=None,
+    ):
+        if model not in MODELS:
+            raise ValueError(
+                "Unknown return timing model {0}, pick one of {1}".format(
+                    model, ", ".join(MODELS)
+                )
+            )
+        self.model = model
+        self.delay = float(delay)
+        self.jitter = float(jitter)
+        self.sigma = float(sigma)
+        self.slow = float(slow_pct) / 100
+        self.slow_delay = float(slow_delay)
+        self.drop = float(drop_pct) / 100
+        self._rand = random.Random(seed)
+
+    @classmethod
+    def from_opts(cls, opts, seed=None):
+        """
+        Build the timing from the ``legion_return_*`` minion config options
+        """
+        return cls(
+            opts.get("legion_return_model", "burst"),
+            opts.get("legion_return_delay", 0.0),
+            opts.get("legion_return_jitter", 0.0),
+            opts.get("legion_return_sigma", 1.0),
+            opts.get("legion_return_slow_pct", 0.0),
+            opts.get("legion_return_slow_delay", 0.0),
+            opts.get("legion_return_drop_pct", 0.0),
+            seed,
+        )
+
+    def draw(self):
+        """
+        Return the seconds after the job one fake returns, None when it does
+        not return
+        """
+        if self.drop and self._rand.random() < self.drop:
+            return None
+        if self.model == "burst":
+            due = 0.0
+        elif self.model == "fixed":
+            due = self.delay
+        elif self.model == "uniform":
+            due = self.delay + self._rand.uniform(0, self.jitter)
+        elif self.jitter > 0:
+            due = self.delay + self._rand.lognormvariate(
+                math.log(self.jitter), self.sigma
+            )
+        else:
+            due = self.delay
+        if self.slow and self._rand.random() < self.slow:
+            due += self.slow_delay
+        return due
+
+
+def dispatch(executor, func, items, timing):
+    """
+    Submit ``func(item)`` to ``executor`` for every item when the ``timing``
+    says it is due, from one thread going down a heap of due times rather than
+    a sleeping thread per item. Returns the futures of the submitted items
+    and the items that were dropped.
+    """
+    start = time.time()
+    heap = []
+    dropped = []
+    for seq, item in enumerate(items):
+        due = timing.draw()
+        if due is None:
+            dropped.append(item)
+        else:
+            heap.append((due, seq, item))
+    heapq.heapify(heap)
+    futures = []
+    while heap:
+        due, _, item = heapq.heappop(heap)
+        wait = start + due - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        futures.append(executor.submit(func, item))
+    return futures, dropped